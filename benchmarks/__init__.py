@@ -0,0 +1 @@
+"""Benchmarks for the hot paths of VoiceMyDocs, run against a local fake of the OpenAI API."""
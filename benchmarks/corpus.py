@@ -0,0 +1,88 @@
+"""Generator of synthetic PDF documents, written without any PDF library.
+
+Each page has a running header and a page number, like the papers that VoiceMyDocs is used for.
+"""
+
+import os
+import random
+
+WORDS = (
+    "adsorption framework porous carbon capture material simulation energy "
+    "selectivity isotherm molecular structure screening database pressure "
+    "temperature binding site metal organic performance experimental"
+).split()
+
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_pdf(pages) -> bytes:
+    """Return the bytes of a PDF with one page for each list of text lines in pages."""
+    npages = len(pages)
+    font_id = 3 + 2 * npages
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        (
+            "<< /Type /Pages /Kids [%s] /Count %d >>"
+            % (" ".join(f"{3 + 2 * i} 0 R" for i in range(npages)), npages)
+        ).encode(),
+    ]
+    for ipage, lines in enumerate(pages):
+        stream = "BT /F1 10 Tf 50 760 Td 12 TL "
+        stream += " ".join(f"({_escape(line)}) '" for line in lines) + " ET"
+        objects.append(
+            (
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                f"/Contents {4 + 2 * ipage} 0 R /Resources << /Font << /F1 {font_id} 0 R >> >> >>"
+            ).encode()
+        )
+        objects.append(
+            f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream".encode()
+        )
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for iobject, content in enumerate(objects):
+        offsets.append(len(pdf))
+        pdf += f"{iobject + 1} 0 obj\n".encode() + content + b"\nendobj\n"
+    xref_offset = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        pdf += f"{offset:010d} 00000 n \n".encode()
+    pdf += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+        f"startxref\n{xref_offset}\n%%EOF\n"
+    ).encode()
+    return bytes(pdf)
+
+
+def make_document(npages=10, lines_per_page=55, seed=0) -> bytes:
+    """Return a synthetic paper with a running header, page numbers and a references section."""
+    rng = random.Random(seed)
+    pages = []
+    for ipage in range(npages):
+        lines = [f"Journal of Synthetic Documents, vol. {seed % 50}, {ipage + 100}"]
+        for _ in range(lines_per_page):
+            lines.append(" ".join(rng.choice(WORDS) for _ in range(12)))
+        if ipage == npages - 1:
+            lines.append("References")
+            lines.extend(
+                f"[{i}] A. Author et al., J. Synth. {i} (2024)" for i in range(10)
+            )
+        lines.append(str(ipage + 1))
+        pages.append(lines)
+    return make_pdf(pages)
+
+
+def generate_corpus(directory, ndocuments=5, npages=10) -> list:
+    """Write ndocuments synthetic PDFs in directory and return their paths."""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for idocument in range(ndocuments):
+        path = os.path.join(directory, f"document_{idocument:03d}.pdf")
+        with open(path, "wb") as pdf_file:
+            pdf_file.write(make_document(npages=npages, seed=idocument))
+        paths.append(path)
+    return paths
@@ -0,0 +1,329 @@
+"""Local stand-in for the OpenAI API, mimicking the chat-completions and audio-speech endpoints,
+and the files and batches endpoints used by the batch mode (python voicemydocs/app.py --batch DIR).
+
+Run it standalone with:
+    python -m benchmarks.fake_openai --port 8765 --latency 0.5
+
+and point the app to it with OPENAI_BASE_URL=http://127.0.0.1:8765/v1
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Header of an MPEG-1 Layer III frame, 128 kbps, 44.1 kHz, no padding: 417 bytes per frame
+MP3_FRAME_HEADER = b"\xff\xfb\x90\x64"
+MP3_FRAME_SIZE = 417
+
+FAKE_SENTENCE = (
+    "This is a sentence generated by the fake OpenAI server for benchmarking purposes."
+)
+
+
+def fake_mp3(size: int) -> bytes:
+    """Return approximately size bytes of silent MP3 frames."""
+    frame = MP3_FRAME_HEADER + b"\x00" * (MP3_FRAME_SIZE - len(MP3_FRAME_HEADER))
+    return frame * max(1, size // MP3_FRAME_SIZE)
+
+
+def fake_wav(size: int, rate: int = 24_000) -> bytes:
+    """Return a WAV of approximately size bytes of silence (16-bit mono PCM)."""
+    data = b"\x00" * (size - size % 2)
+    fmt = (1).to_bytes(2, "little") + (1).to_bytes(2, "little")
+    fmt += rate.to_bytes(4, "little") + (2 * rate).to_bytes(4, "little")
+    fmt += (2).to_bytes(2, "little") + (16).to_bytes(2, "little")
+    return (
+        b"RIFF"
+        + (4 + 8 + len(fmt) + 8 + len(data)).to_bytes(4, "little")
+        + b"WAVEfmt "
+        + len(fmt).to_bytes(4, "little")
+        + fmt
+        + b"data"
+        + len(data).to_bytes(4, "little")
+        + data
+    )
+
+
+def fake_dialogue(nturns: int, sentences_per_turn: int = 3) -> str:
+    """Return a transcript in the format requested by DEFAULT_TRANSCRIPT_PROMPT.
+    Each turn is numbered, so that they are distinct segments to synthesize.
+    """
+    lines = []
+    for iturn in range(nturns):
+        lines.append(f"<speaker{iturn % 2 + 1}>")
+        lines.append(
+            f"Turn {iturn + 1}. " + " ".join([FAKE_SENTENCE] * sentences_per_turn)
+        )
+    return "\n".join(lines)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass  # keep the benchmark output clean
+
+    def _send(self, status, body: bytes, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, data, headers=None):
+        self._send(status, json.dumps(data).encode(), headers=headers)
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _read_json(self):
+        return json.loads(self._read_body() or b"{}")
+
+    def _read_multipart_file(self) -> bytes:
+        """Return the contents of the "file" field of a multipart/form-data upload."""
+        boundary = self.headers["Content-Type"].split("boundary=")[1].strip('"')
+        for part in self._read_body().split(b"--" + boundary.encode()):
+            head, _, content = part.partition(b"\r\n\r\n")
+            if b'name="file"' in head:
+                return content[: -len(b"\r\n")]
+        return b""
+
+    def _simulate(self) -> bool:
+        """Sleep for the configured latency and return False if the request must be rate limited."""
+        config = self.server.config
+        self.server.count("requests")
+        time.sleep(max(0.0, config.latency + random.uniform(-1, 1) * config.jitter))
+        if random.random() < config.error_rate:
+            self.server.count("rate_limited")
+            self._send_json(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                headers={"retry-after-ms": str(int(config.retry_after * 1000))},
+            )
+            return False
+        return True
+
+    def do_POST(self):
+        if self.path.endswith("/chat/completions"):
+            body = self._read_json()
+            if self._simulate():
+                self._send_json(200, self.server.chat_completion(body))
+        elif self.path.endswith("/audio/speech"):
+            response_format = self._read_json().get("response_format", "mp3")
+            if self._simulate():
+                # the containers that matter for concatenation, else MP3 frames
+                if response_format == "wav":
+                    audio = fake_wav(len(self.server.mp3))
+                elif response_format == "pcm":
+                    audio = b"\x00" * len(self.server.mp3)
+                else:
+                    audio = self.server.mp3
+                self.server.count("tts_bytes", len(audio))
+                self._send(200, audio, content_type="application/octet-stream")
+        elif self.path.endswith("/files"):
+            self._send_json(200, self.server.create_file(self._read_multipart_file()))
+        elif self.path.endswith("/batches"):
+            self._send_json(200, self.server.create_batch(self._read_json()))
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_GET(self):
+        parts = ["", ""] + self.path.split("?")[0].rstrip("/").split("/")
+        if parts[-3] == "files" and parts[-1] == "content":
+            content = self.server.files.get(parts[-2])
+            if content is not None:
+                return self._send(200, content, content_type="application/octet-stream")
+        elif parts[-2] == "batches" and parts[-1] in self.server.batches:
+            return self._send_json(200, self.server.batches[parts[-1]])
+        self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+
+class FakeOpenAIConfig:
+    def __init__(
+        self,
+        latency=0.2,
+        jitter=0.05,
+        error_rate=0.0,
+        retry_after=0.01,
+        mp3_size=32_000,
+        dialogue_turns=20,
+        batch_latency=1.0,
+    ):
+        self.latency = latency  # seconds per request
+        self.jitter = jitter  # seconds, uniformly distributed around the latency
+        self.error_rate = error_rate  # fraction of requests answered with 429
+        self.retry_after = retry_after  # seconds suggested to the client after a 429
+        self.mp3_size = mp3_size  # bytes of each audio/speech response
+        self.dialogue_turns = dialogue_turns  # turns in each chat completion
+        self.batch_latency = batch_latency  # seconds before a batch is completed
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """Threaded HTTP server answering like the OpenAI API, to be used as context manager:
+
+    with FakeOpenAIServer(FakeOpenAIConfig(latency=0.1)) as server:
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+    """
+
+    daemon_threads = True
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        super().__init__((host, port), FakeOpenAIHandler)
+        self.config = config or FakeOpenAIConfig()
+        self.mp3 = fake_mp3(self.config.mp3_size)
+        self.dialogue = fake_dialogue(self.config.dialogue_turns)
+        self.stats = {"requests": 0, "rate_limited": 0, "tts_bytes": 0, "batches": 0}
+        self.files = {}
+        self.batches = {}
+        self._stats_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, key, value=1):
+        with self._stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + value
+
+    def chat_completion(self, body):
+        prompt_chars = sum(
+            len(m.get("content") or "") for m in body.get("messages", [])
+        )
+        return {
+            "id": f"chatcmpl-fake{random.getrandbits(32):08x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": self.dialogue},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_chars // 4,
+                "completion_tokens": len(self.dialogue) // 4,
+                "total_tokens": (prompt_chars + len(self.dialogue)) // 4,
+            },
+        }
+
+    def create_file(self, content):
+        file_id = f"file-fake{random.getrandbits(32):08x}"
+        self.files[file_id] = content
+        return {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": f"{file_id}.jsonl",
+            "purpose": "batch",
+            "status": "processed",
+        }
+
+    def create_batch(self, body):
+        self.count("batches")
+        batch_id = f"batch_fake{random.getrandbits(32):08x}"
+        self.batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"],
+            "completion_window": body["completion_window"],
+            "status": "in_progress",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        timer = threading.Timer(
+            self.config.batch_latency, self._complete_batch, args=(batch_id,)
+        )
+        timer.daemon = True
+        timer.start()
+        return self.batches[batch_id]
+
+    def _complete_batch(self, batch_id):
+        """Answer every request of the batch, failing a fraction of them according to the error rate."""
+        batch = self.batches[batch_id]
+        outputs, errors = [], []
+        for line in self.files[batch["input_file_id"]].decode().splitlines():
+            request = json.loads(line)
+            self.count("requests")
+            if random.random() < self.config.error_rate:
+                response = {
+                    "status_code": 429,
+                    "body": {"error": {"message": "Rate limit reached"}},
+                }
+                errors.append({"custom_id": request["custom_id"], "response": response})
+            else:
+                response = {
+                    "status_code": 200,
+                    "body": self.chat_completion(request["body"]),
+                }
+                outputs.append(
+                    {"custom_id": request["custom_id"], "response": response}
+                )
+
+        for key, lines in (("output_file_id", outputs), ("error_file_id", errors)):
+            if lines:
+                content = "\n".join(json.dumps(x) for x in lines).encode()
+                batch[key] = self.create_file(content)["id"]
+        batch["request_counts"] = {
+            "total": len(outputs) + len(errors),
+            "completed": len(outputs),
+            "failed": len(errors),
+        }
+        batch["status"] = "completed"
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+def add_config_arguments(parser):
+    defaults = FakeOpenAIConfig()
+    parser.add_argument("--latency", type=float, default=defaults.latency)
+    parser.add_argument("--jitter", type=float, default=defaults.jitter)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument("--mp3-size", type=int, default=defaults.mp3_size)
+    parser.add_argument("--dialogue-turns", type=int, default=defaults.dialogue_turns)
+    parser.add_argument("--batch-latency", type=float, default=defaults.batch_latency)
+
+
+def config_from_arguments(args):
+    return FakeOpenAIConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        mp3_size=args.mp3_size,
+        dialogue_turns=args.dialogue_turns,
+        batch_latency=args.batch_latency,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fake OpenAI API server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(config_from_arguments(args), args.host, args.port)
+    print(f"Fake OpenAI API listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
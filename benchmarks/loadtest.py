@@ -0,0 +1,365 @@
+"""Load test of the Dash app, driving its callback endpoint (/_dash-update-component)
+with scripted user sessions: upload, summarize, transcript, TTS and load of a previous project.
+
+Against an app already running (pointed to the fake OpenAI server):
+    python -m benchmarks.loadtest --url http://127.0.0.1:8050 --users 1,2,4,8
+
+Or spawning the app and the fake OpenAI server:
+    python -m benchmarks.loadtest --spawn --users 1,2,4,8 --latency 0.5
+
+Or spawning the production server, with several worker processes:
+    python -m benchmarks.loadtest --spawn --workers 4 --users 1,2,4,8,16
+
+For each number of concurrent users, the report includes the latency percentiles of each callback
+(labelled by its triggering input), the throughput, and the saturation point: the first level where
+adding users no longer increases the throughput by more than --saturation-gain.
+"""
+
+import argparse
+import base64
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+
+from benchmarks.corpus import make_document
+from benchmarks.fake_openai import (
+    FakeOpenAIServer,
+    add_config_arguments,
+    config_from_arguments,
+)
+from benchmarks.run import percentile
+
+MAX_CHAIN_DEPTH = 5
+
+
+def http_json(url, payload=None, timeout=600):
+    data = None if payload is None else json.dumps(payload).encode()
+    request = urllib.request.Request(
+        url, data=data, headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        body = response.read()
+    return json.loads(body) if body else None
+
+
+def layout_values(component, values=None):
+    """Collect the initial values of the properties of each component with an id, as the browser does."""
+    values = {} if values is None else values
+    if isinstance(component, list):
+        for child in component:
+            layout_values(child, values)
+    elif isinstance(component, dict) and "props" in component:
+        props = component["props"]
+        if isinstance(props.get("id"), str):
+            for prop, value in props.items():
+                if prop not in ("id", "children") or isinstance(
+                    value, (str, int, float)
+                ):
+                    values[f"{props['id']}.{prop}"] = value
+        layout_values(props.get("children"), values)
+    return values
+
+
+def split_output(output):
+    """Split the output of a dependency, e.g., '..a.value...b.data..' into [('a', 'value'), ('b', 'data')]."""
+    if output.startswith(".."):
+        return [tuple(x.rsplit(".", 1)) for x in output[2:-2].split("...")], True
+    return [tuple(output.rsplit(".", 1))], False
+
+
+class DashSession:
+    """One simulated browser: it keeps the values of the components, calls the server-side callbacks
+    like the Dash renderer, and chains the callbacks triggered by their outputs.
+    """
+
+    def __init__(self, base_url, dependencies, initial_values, recorder):
+        self.base_url = base_url.rstrip("/")
+        self.dependencies = dependencies
+        self.recorder = recorder
+        self.values = dict(initial_values)
+        self.values["input-openai-api-key.value"] = "sk-fake"
+
+    def _find(self, trigger):
+        return [
+            dependency
+            for dependency in self.dependencies
+            if not dependency.get("clientside_function")
+            and any(
+                f"{x['id']}.{x['property']}" == trigger for x in dependency["inputs"]
+            )
+        ]
+
+    def _call_dependency(self, dependency, trigger):
+        outputs, multi = split_output(dependency["output"])
+        payload = {
+            "output": dependency["output"],
+            "outputs": [{"id": i, "property": p} for i, p in outputs]
+            if multi
+            else {"id": outputs[0][0], "property": outputs[0][1]},
+            "inputs": [
+                dict(x, value=self.values.get(f"{x['id']}.{x['property']}"))
+                for x in dependency["inputs"]
+            ],
+            "state": [
+                dict(x, value=self.values.get(f"{x['id']}.{x['property']}"))
+                for x in dependency["state"]
+            ],
+            "changedPropIds": [trigger],
+        }
+        start = time.perf_counter()
+        try:
+            response = http_json(f"{self.base_url}/_dash-update-component", payload)
+        except urllib.error.HTTPError as e:
+            if e.code == 204:  # PreventUpdate
+                response = None
+            else:
+                self.recorder.record(trigger, time.perf_counter() - start, error=True)
+                raise
+        self.recorder.record(trigger, time.perf_counter() - start)
+
+        changed = []
+        for component_id, props in ((response or {}).get("response") or {}).items():
+            for prop, value in props.items():
+                key = f"{component_id}.{prop}"
+                self.values[key] = value
+                changed.append(key)
+        return changed
+
+    def trigger(self, trigger, value=None, depth=0, source=None):
+        """Set the value of an input and run the callbacks it triggers, then the ones triggered by their outputs.
+        As in Dash, a callback is not triggered by its own outputs (source).
+        """
+        if value is not None:
+            self.values[trigger] = value
+        for dependency in self._find(trigger):
+            if dependency["output"] == source:
+                continue
+            changed = self._call_dependency(dependency, trigger)
+            self.emulate_clientside(changed)
+            if depth < MAX_CHAIN_DEPTH:
+                for key in changed:
+                    self.trigger(key, depth=depth + 1, source=dependency["output"])
+
+    def emulate_clientside(self, changed):
+        """Reproduce the effect of the clientside callbacks on the values held by the session."""
+        for step in ("file", "summary", "transcript"):
+            push = self.values.get(f"push-{step}.data")
+            if f"push-{step}.data" not in changed or not push:
+                continue
+            text = push.get("text") or ""
+            view, edit = f"textarea-{step}.value", f"textarea-{step}-edit.value"
+            if push.get("append"):
+                self.values[view] = (self.values.get(view) or "") + text
+                self.values[edit] = (self.values.get(edit) or "") + text
+            else:
+                if push.get("view"):
+                    self.values[view] = text
+                self.values[edit] = text
+
+    def run_script(self, pdf_contents, poll_interval=0.5, timeout=300):
+        self.trigger("url.pathname", "/page-1")
+        self.trigger("upload-pdf.contents", pdf_contents)
+        deadline = time.time() + timeout
+        while not self.values.get("interval-extraction.disabled", True):
+            if time.time() > deadline:
+                raise TimeoutError("The extraction did not complete")
+            time.sleep(poll_interval)
+            n_intervals = (self.values.get("interval-extraction.n_intervals") or 0) + 1
+            self.trigger("interval-extraction.n_intervals", n_intervals)
+
+        self.trigger("button-generate-summary.n_clicks", 1)
+        self.trigger("button-generate-transcript.n_clicks", 1)
+        self.trigger("button-tts.n_clicks", 1)
+
+        self.trigger("previous-projects-info.children", "")
+        options = self.values.get("dropdown-previous-projects.options") or []
+        if options:
+            project = options[0]
+            self.trigger(
+                "dropdown-previous-projects.value",
+                project["value"] if isinstance(project, dict) else project,
+            )
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, label, seconds, error=False):
+        with self.lock:
+            if error:
+                self.errors[label] += 1
+            else:
+                self.latencies[label].append(seconds)
+
+
+def run_level(
+    base_url, dependencies, initial_values, users, sessions_per_user, pdf_contents
+):
+    recorder = Recorder()
+    failed_sessions = []
+
+    def user():
+        for _ in range(sessions_per_user):
+            try:
+                DashSession(
+                    base_url, dependencies, initial_values, recorder
+                ).run_script(pdf_contents)
+            except Exception as e:
+                failed_sessions.append(repr(e))
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=user) for _ in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    sessions = users * sessions_per_user - len(failed_sessions)
+    ncalls = sum(len(x) for x in recorder.latencies.values())
+    return {
+        "users": users,
+        "seconds": round(seconds, 3),
+        "sessions_completed": sessions,
+        "sessions_failed": len(failed_sessions),
+        "failures": failed_sessions[:5],
+        "sessions_per_second": round(sessions / seconds, 4),
+        "callbacks_per_second": round(ncalls / seconds, 2),
+        "callbacks": {
+            label: {
+                "count": len(latencies),
+                "errors": recorder.errors.get(label, 0),
+                "p50": round(percentile(sorted(latencies), 50), 4),
+                "p90": round(percentile(sorted(latencies), 90), 4),
+                "p99": round(percentile(sorted(latencies), 99), 4),
+                "max": round(max(latencies), 4),
+            }
+            for label, latencies in sorted(recorder.latencies.items())
+        },
+    }
+
+
+def find_saturation(levels, min_gain):
+    """Return the number of users after which the throughput stops increasing by more than min_gain."""
+    for previous, level in zip(levels, levels[1:]):
+        if level["sessions_per_second"] < previous["sessions_per_second"] * (
+            1 + min_gain
+        ):
+            return previous["users"]
+    return None  # not saturated within the tested levels
+
+
+def wait_for_server(base_url, timeout=60):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return http_json(f"{base_url}/_dash-dependencies")
+        except (urllib.error.URLError, ConnectionError):
+            if time.time() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the VoiceMyDocs app.")
+    parser.add_argument("--url", default="http://127.0.0.1:8050")
+    parser.add_argument(
+        "--spawn",
+        action="store_true",
+        help="Start the app (on the port of --url) and a fake OpenAI server.",
+    )
+    parser.add_argument("--users", default="1,2,4,8", help="Concurrent users to test.")
+    parser.add_argument("--sessions-per-user", type=int, default=2)
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--saturation-gain", type=float, default=0.1)
+    parser.add_argument(
+        "--label", default="", help="Description of the worker configuration."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="With --spawn, run voicemydocs serve with this many processes "
+        "(default 0: the development server).",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=8, help="Threads of each process of --workers."
+    )
+    parser.add_argument("--output", help="Write the JSON report here (default stdout).")
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+
+    pdf_contents = "data:application/pdf;base64," + base64.b64encode(
+        make_document(npages=args.pages)
+    ).decode("utf-8")
+
+    fake_openai, app_process = None, None
+    try:
+        if args.spawn:
+            fake_openai = FakeOpenAIServer(config_from_arguments(args)).__enter__()
+            port = args.url.rsplit(":", 1)[-1].strip("/")
+            if args.workers:
+                command = ["-m", "voicemydocs.main", "serve", "--port", port]
+                command += [
+                    "--workers",
+                    str(args.workers),
+                    "--threads",
+                    str(args.threads),
+                ]
+            else:
+                command = ["voicemydocs/app.py", "--port", port]
+            app_process = subprocess.Popen(
+                [sys.executable, *command],
+                env=dict(os.environ, OPENAI_BASE_URL=fake_openai.base_url),
+                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                stdout=sys.stderr,  # keep stdout for the report
+            )
+        dependencies = wait_for_server(args.url)
+        initial_values = layout_values(http_json(f"{args.url}/_dash-layout"))
+
+        levels = []
+        for users in [int(x) for x in args.users.split(",")]:
+            levels.append(
+                run_level(
+                    args.url,
+                    dependencies,
+                    initial_values,
+                    users,
+                    args.sessions_per_user,
+                    pdf_contents,
+                )
+            )
+        report = {
+            "label": args.label,
+            "url": args.url,
+            "levels": levels,
+            "saturation_users": find_saturation(levels, args.saturation_gain),
+        }
+        if fake_openai is not None:
+            report["fake_openai"] = vars(fake_openai.config).copy()
+    finally:
+        if app_process is not None:
+            app_process.terminate()
+            app_process.wait()
+        if fake_openai is not None:
+            fake_openai.__exit__(None, None, None)
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""Measure the throughput and latency of the hot paths of VoiceMyDocs against the fake OpenAI server.
+
+    python -m benchmarks.run --documents 5 --pages 20 --latency 0.2 --output bench.json
+
+The report is a JSON with, for each stage, the total time, the requests (or items) per second,
+the latency percentiles and the peak RSS of the process at the end of the stage.
+"""
+
+import argparse
+import concurrent.futures as cf
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks.corpus import generate_corpus
+from benchmarks.fake_openai import (
+    FakeOpenAIServer,
+    add_config_arguments,
+    config_from_arguments,
+    fake_dialogue,
+)
+
+
+def peak_rss_mb() -> float:
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024**2 if sys.platform == "darwin" else maxrss / 1024
+
+
+def percentile(values, q) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def summarize(latencies, seconds, nitems=None, **extra) -> dict:
+    nitems = len(latencies) if nitems is None else nitems
+    return {
+        "seconds": round(seconds, 4),
+        "count": nitems,
+        "per_second": round(nitems / seconds, 2) if seconds else None,
+        "p50": round(percentile(latencies, 50), 4),
+        "p95": round(percentile(latencies, 95), 4),
+        "max": round(max(latencies), 4) if latencies else 0.0,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        **extra,
+    }
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def bench_extraction(app, paths) -> dict:
+    latencies, npages, nchars = [], 0, 0
+    start = time.perf_counter()
+    for path in paths:
+        page_start = time.perf_counter()
+        for page in app.iter_pdf_pages(path):
+            latencies.append(time.perf_counter() - page_start)
+            npages += 1
+            nchars += len(page)
+            page_start = time.perf_counter()
+    seconds = time.perf_counter() - start
+    return summarize(latencies, seconds, npages, unit="page", chars=nchars)
+
+
+def bench_llm(app, text, nrequests, concurrency) -> dict:
+    def call(_):
+        return timed(
+            app.call_llm_api,
+            system_content=app.DEFAULT_SUMMARY_PROMPT,
+            user_content=text,
+            model=app.MODEL_DEFAULT,
+            api_keys={"openai": "sk-fake"},
+        )[0]
+
+    call(None)  # warm up, excluding the lazy import of openai
+    start = time.perf_counter()
+    with cf.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(call, range(nrequests)))
+    seconds = time.perf_counter() - start
+    return summarize(latencies, seconds, unit="request", concurrency=concurrency)
+
+
+def bench_tts(app, dialogue, repeats) -> dict:
+    nturns = len(app.dialogue_text2list(dialogue))
+    latencies, nbytes = [], 0
+    segment_directory = app.SEGMENT_DIRECTORY
+    for _ in range(repeats):
+        with tempfile.TemporaryDirectory() as directory:
+            app.SEGMENT_DIRECTORY = (
+                directory  # measure the synthesis, not the segment store
+            )
+            seconds, audio = timed(app.compile_dialogue, dialogue, api_key="sk-fake")
+            while app.TTS_JOBS_RUNNING:  # the job releases its last segment locks
+                time.sleep(0.01)
+        app.SEGMENT_DIRECTORY = segment_directory
+        latencies.append(seconds)
+        nbytes += len(audio)
+    seconds = sum(latencies)
+    return summarize(
+        latencies,
+        seconds,
+        nturns * repeats,
+        unit="segment",
+        audio_bytes=nbytes,
+    )
+
+
+def bench_dialogue_parsing(app, nturns, repeats) -> dict:
+    dialogue = fake_dialogue(nturns)
+    latencies = []
+    for _ in range(repeats):
+        app.DIALOGUE_CACHE.clear()  # measure the parsing, not the memoization
+        latencies.append(timed(app.dialogue_text2list, dialogue)[0])
+    seconds = sum(latencies)
+    return summarize(
+        latencies, seconds, nturns * repeats, unit="turn", chars=len(dialogue)
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the VoiceMyDocs hot paths.")
+    parser.add_argument("--documents", type=int, default=3)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--llm-requests", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--tts-repeats", type=int, default=3)
+    parser.add_argument("--parse-turns", type=int, default=100_000)
+    parser.add_argument("--output", help="Write the JSON report here (default stdout).")
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with FakeOpenAIServer(config_from_arguments(args)) as server:
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        from voicemydocs import app
+
+        report = {"fake_openai": vars(server.config).copy(), "stages": {}}
+        with tempfile.TemporaryDirectory() as corpus_directory:
+            paths = generate_corpus(corpus_directory, args.documents, args.pages)
+            stages = report["stages"]
+            stages["extract_text_from_pdf"] = bench_extraction(app, paths)
+            text = app.extract_text_from_pdf(paths[0])
+
+        stages["call_llm_api"] = bench_llm(
+            app, text, args.llm_requests, args.concurrency
+        )
+        stages["compile_dialogue"] = bench_tts(app, server.dialogue, args.tts_repeats)
+        stages["dialogue_text2list"] = bench_dialogue_parsing(
+            app, args.parse_turns, repeats=3
+        )
+        report["fake_openai_stats"] = dict(server.stats)
+        report["peak_rss_mb"] = round(peak_rss_mb(), 1)
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,8 +14,12 @@ setup(
     extras_require={
         "dev": [
             "pre-commit",
+            "pytest",
             "ruff~=0.6.9",
         ],
+        "serve": [
+            "gunicorn",
+        ],
     },
     entry_points={
         "console_scripts": [
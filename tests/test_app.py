@@ -0,0 +1,162 @@
+import random
+
+import pytest
+
+from voicemydocs import app
+
+
+def random_edit(rng, text):
+    """Replace a random range of a text with random lines or characters."""
+    start = rng.randint(0, len(text))
+    end = rng.randint(start, min(len(text), start + 40))
+    insert = rng.choice(["", "new line\n", "x", "\n", "é€\n" * rng.randint(1, 3)])
+    return text[:start] + insert + text[end:], (start, end, insert)
+
+
+#### DRAFTS ###########################################################################################################
+
+
+@pytest.mark.parametrize(
+    "parent_value, value",
+    [
+        ("", ""),
+        ("", "a\nb\n"),
+        ("a\nb\n", ""),
+        ("a\nb\nc\n", "a\nB\nc\n"),
+        ("a\nb\nc", "a\nb\nc\nd"),  # no final newline
+        ("same\n" * 50, "same\n" * 50),
+        ([], [{"speaker": 1, "text": "Hi"}]),
+        ([{"speaker": 1, "text": "Hi"}] * 20, [{"speaker": 2, "text": "Hi"}] * 20),
+        (["key1", "key2", "key3"] * 10, ["key1", "key3"] * 10),
+    ],
+)
+def test_draft_value_roundtrip(parent_value, value):
+    stored = app.diff_draft_value(parent_value, value)
+    if isinstance(stored, dict):
+        assert app.patch_draft_value(parent_value, stored) == value
+    else:
+        assert stored == value
+
+
+def test_draft_value_roundtrip_random_edits():
+    rng = random.Random(0)
+    parent_value = "".join(f"line {i}\n" for i in range(200))
+    for _ in range(200):
+        value, _ = random_edit(rng, parent_value)
+        stored = app.diff_draft_value(parent_value, value)
+        if isinstance(stored, dict):
+            assert app.patch_draft_value(parent_value, stored) == value
+        else:
+            assert stored == value
+        parent_value = value
+
+
+def test_draft_value_not_diffed():
+    assert app.diff_draft_value("gpt-4o", "gpt-4o-mini") == "gpt-4o-mini"  # not smaller
+    assert app.diff_draft_value(3, 4) == 4
+    assert app.diff_draft_value("a\n", ["a"]) == ["a"]
+
+
+#### TEXT STORES ######################################################################################################
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def text_store(request, tmp_path):
+    if request.param == "memory":
+        return app.TextStore()
+    return app.SQLiteTextStore(str(tmp_path / "texts.sqlite"))
+
+
+def test_text_store_apply_diff_roundtrip(text_store):
+    rng = random.Random(1)
+    text_store.register("s")
+    text = "".join(f"line {i}\n" for i in range(50))
+    version = text_store.set("s", "file", text)
+    for cid in range(1, 100):
+        text, (start, end, insert) = random_edit(rng, text)
+        ack = text_store.apply_diff(
+            "s",
+            "file",
+            {"cid": cid, "base": version, "start": start, "end": end, "text": insert},
+        )
+        version = ack["version"]
+        assert text_store.get("s", "file") == text
+    assert not text_store.is_lost("s", "file")
+
+
+def test_text_store_ignores_late_diffs(text_store):
+    text_store.register("s")
+    version = text_store.set("s", "file", "abc")
+    diff = {"cid": 2, "base": version, "start": 0, "end": 1, "text": "A"}
+    assert text_store.apply_diff("s", "file", diff)["version"] > version
+    late = {"cid": 1, "base": version, "start": 0, "end": 0, "text": "late"}
+    assert text_store.apply_diff("s", "file", late) is None
+    assert text_store.get("s", "file") == "Abc"
+
+
+def test_text_store_lost_session(text_store):
+    assert text_store.is_lost("unknown", "file")
+    assert text_store.get("unknown", "file") == ""
+    ack = text_store.apply_diff(
+        "unknown", "file", {"cid": 1, "base": 3, "start": 0, "end": 0, "text": "x"}
+    )
+    assert ack == {"cid": 1, "resync": True}
+    full = {"cid": 2, "base": -1, "start": 0, "end": 0, "text": "full text"}
+    assert text_store.apply_diff("unknown", "file", full)["version"] > 0
+    assert text_store.get("unknown", "file") == "full text"
+    assert not text_store.is_lost("unknown", "file")
+
+
+#### AUDIO ############################################################################################################
+
+
+def test_concat_wav_roundtrip():
+    segments_data = [bytes(range(10)), bytes(range(100, 120)), b""]
+    segments = [app.wav_header(len(x)) + x for x in segments_data]
+    fmt_chunk, data = app.split_wav(app.concat_audio(segments, "wav"))
+    assert data == b"".join(segments_data)
+    assert fmt_chunk == app.split_wav(segments[0])[0]
+
+
+def test_concat_pcm_and_streamed_wav():
+    fmt_chunk, data = app.split_wav(app.concat_audio([b"ab", b"cd"], "pcm"))
+    assert data == b"abcd"
+    streamed = b"".join(app.iter_stream_audio([app.wav_header(2) + b"ab"] * 2, "wav"))
+    assert app.split_wav(streamed)[1] == b"abab"  # placeholder size: data to the end
+
+
+def test_concat_frames():
+    assert app.concat_audio([b"ID3a", b"b"], "mp3") == b"ID3ab"
+
+
+def test_split_wav_invalid():
+    with pytest.raises(ValueError):
+        app.split_wav(b"RIFF\x00\x00\x00\x00WAVE")
+
+
+#### DIALOGUE #########################################################################################################
+
+
+@pytest.mark.parametrize(
+    "dialogue, turns",
+    [
+        ("<speaker1>\nHi\n<speaker2>\nHello", [(1, "Hi"), (2, "Hello")]),
+        ("Intro\n<speaker1>\nHi\n\n  Again  ", [(1, "Hi"), (1, "Again")]),
+        (
+            "<Alice> Hi there\n<Bob> Hello\n<Alice> Bye",
+            [(1, "Hi there"), (2, "Hello"), (1, "Bye")],
+        ),
+        ("<Alice>\nHi\n<Bob> Hello", [(1, "Hi"), (2, "Hello")]),
+        ("<speaker1> Hi\n<laughs> Funny", [(1, "Hi"), (1, "<laughs> Funny")]),
+        ("<Dr. Smith> Hi\n<Ann> <laughs> yes", [(1, "Hi"), (2, "<laughs> yes")]),
+        ("", []),
+    ],
+)
+def test_iter_dialogue(dialogue, turns):
+    assert list(app.iter_dialogue(dialogue)) == turns
+
+
+def test_dialogue_too_many_speakers():
+    dialogue = "<A> a\n<B> b\n<C> c\n<D> d"
+    with pytest.raises(ValueError, match="4 speakers"):
+        app.get_dialogue_segments(dialogue, ["nova", "echo", "onyx"], "tts-1")
@@ -0,0 +1 @@
+"""VoiceMyDocs: convert PDF files to engaging audios and podcasts."""
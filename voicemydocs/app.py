@@ -1,24 +1,247 @@
 import os
 import argparse
 import base64
+import contextlib
 import io
 import json
+import hashlib
+import mmap
+import re
+import sqlite3
+from collections import Counter, OrderedDict, deque
 from datetime import datetime
-from PyPDF2 import PdfReader
-from openai import OpenAI
+from html import escape as html_escape
 from dotenv import load_dotenv
 import concurrent.futures as cf
+import cProfile
+import difflib
+import pstats
+import functools
+import threading
+import time
 
 import dash
-from dash import html, dcc, Input, State, Output
+from dash import html, dcc, Input, State, Output, ALL, ctx
 import dash_bootstrap_components as dbc
 
-from flask import Flask, send_from_directory
+from flask import Flask, Response, abort, send_file, send_from_directory
 
 # Search for a .env file in the current directory and load api key
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+################### METRICS ###########################################################################################
+
+HISTOGRAM_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+METRICS_FLUSH_SECONDS = 1
+
+
+def write_atomic(path, data):
+    """Write a file (text or bytes) through a temporary one, so that it is never read partially written,
+    by another thread or process.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb" if isinstance(data, bytes) else "w") as tmp_file:
+        tmp_file.write(data)
+    os.replace(tmp_path, path)
+
+
+class Metrics:
+    """Thread-safe registry of counters, gauges and histograms, rendered in the Prometheus text format.
+    Recording a value is a dictionary update under a lock: the text is only built when /metrics is scraped.
+
+    With a directory (several worker processes), each process writes its values there every METRICS_FLUSH_SECONDS,
+    and /metrics sums the ones of all the processes, whichever answers: the counters keep the values
+    of the workers that exited, while the gauges only count the processes still alive.
+    """
+
+    def __init__(self, directory=None):
+        self._lock = threading.Lock()
+        self._descriptions = {}  # name -> (type, help)
+        self._values = {}  # (name, labels) -> value, or [bucket counts, sum, count] for histograms
+        self._directory = directory
+        self._path = None  # the file of this process in the directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            os.register_at_fork(after_in_child=self._start_process)
+            self._start_process()
+
+    def _start_process(self):
+        """Start with no values in a new process (not the ones inherited from its parent), and flush them periodically."""
+        self._lock = threading.Lock()
+        self._values = {}
+        self._path = os.path.join(
+            self._directory, f"{os.getpid()}_{os.urandom(4).hex()}.json"
+        )
+
+        def flush_loop():
+            while True:
+                time.sleep(METRICS_FLUSH_SECONDS)
+                self._flush()
+
+        threading.Thread(target=flush_loop, daemon=True).start()
+
+    def describe(self, name, metric_type, help_text):
+        self._descriptions[name] = (metric_type, help_text)
+
+    def inc(self, name, value=1, **labels):
+        """Increment a counter, or a gauge if value is negative."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Add an observation to a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(HISTOGRAM_BUCKETS), 0.0, 0]
+            histogram = self._values[key]
+            for ibucket, bucket in enumerate(HISTOGRAM_BUCKETS):
+                if value <= bucket:
+                    histogram[0][ibucket] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def _snapshot(self):
+        with self._lock:
+            return {
+                key: [list(value[0]), value[1], value[2]]
+                if isinstance(value, list)
+                else value
+                for key, value in self._values.items()
+            }
+
+    def _flush(self):
+        """Write the values of this process, skipping the tick on failure (so that the flush loop goes on)."""
+        snapshot = [
+            [name, labels, value] for (name, labels), value in self._snapshot().items()
+        ]
+        try:
+            os.makedirs(self._directory, exist_ok=True)  # e.g., cleaned from /tmp
+            write_atomic(self._path, json.dumps(snapshot))
+        except OSError:
+            pass
+
+    def _merged(self):
+        """Sum the values written by all the processes."""
+        self._flush()
+        values = {}
+        for entry in os.scandir(self._directory):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path) as metrics_file:
+                    snapshot = json.load(metrics_file)
+            except (OSError, ValueError):
+                continue  # e.g., removed meanwhile
+            alive = is_process_alive(int(entry.name.split("_")[0]))
+            for name, labels, value in snapshot:
+                if self._descriptions.get(name, ("",))[0] == "gauge" and not alive:
+                    continue
+                key = (name, tuple(tuple(label) for label in labels))
+                if not isinstance(value, list):
+                    values[key] = values.get(key, 0) + value
+                    continue
+                histogram = values.setdefault(
+                    key, [[0] * len(HISTOGRAM_BUCKETS), 0.0, 0]
+                )
+                histogram[0] = [a + b for a, b in zip(histogram[0], value[0])]
+                histogram[1] += value[1]
+                histogram[2] += value[2]
+        return values
+
+    def render(self) -> str:
+        values = self._snapshot() if self._directory is None else self._merged()
+
+        def format_labels(labels):
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+        lines = []
+        for name, (metric_type, help_text) in sorted(self._descriptions.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for (value_name, labels), value in sorted(values.items()):
+                if value_name != name:
+                    continue
+                if metric_type != "histogram":
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+                bucket_counts, total, count = value
+                for bucket, bucket_count in zip(HISTOGRAM_BUCKETS, bucket_counts):
+                    bucket_labels = format_labels(labels + (("le", str(bucket)),))
+                    lines.append(f"{name}_bucket{bucket_labels} {bucket_count}")
+                inf_labels = format_labels(labels + (("le", "+Inf"),))
+                lines.append(f"{name}_bucket{inf_labels} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def is_process_alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # alive, but of another user
+    return True
+
+
+METRICS = Metrics(os.getenv("VOICEMYDOCS_METRICS_DIRECTORY"))
+METRICS.describe(
+    "voicemydocs_stage_duration_seconds", "histogram", "Duration of each stage call."
+)
+METRICS.describe(
+    "voicemydocs_stage_in_flight", "gauge", "Number of stage calls in progress."
+)
+METRICS.describe(
+    "voicemydocs_stage_errors_total", "counter", "Number of stage calls that failed."
+)
+METRICS.describe(
+    "voicemydocs_bytes_total", "counter", "Bytes processed, by stage and direction."
+)
+METRICS.describe(
+    "voicemydocs_chars_total",
+    "counter",
+    "Characters processed, by stage and direction.",
+)
+METRICS.describe(
+    "voicemydocs_items_total", "counter", "Pages or segments processed, by stage."
+)
+METRICS.describe(
+    "voicemydocs_cache_total", "counter", "Lookups in the caches, by cache and result."
+)
+
+
+def instrumented(stage):
+    """Decorator recording the duration, the calls in progress and the errors of a stage."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            METRICS.inc("voicemydocs_stage_in_flight", stage=stage)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                METRICS.inc("voicemydocs_stage_errors_total", stage=stage)
+                raise
+            finally:
+                METRICS.observe(
+                    "voicemydocs_stage_duration_seconds",
+                    time.perf_counter() - start,
+                    stage=stage,
+                )
+                METRICS.inc("voicemydocs_stage_in_flight", -1, stage=stage)
+
+        return wrapper
+
+    return decorator
+
+
 ################### CONSTANTS & FUNCTIONS #############################################################################
 
 CACHE_DIRECTORY = os.path.join(
@@ -26,6 +249,25 @@ CACHE_DIRECTORY = os.path.join(
 )
 os.makedirs(CACHE_DIRECTORY, exist_ok=True)
 
+UPLOAD_DIRECTORY = os.path.join(CACHE_DIRECTORY, "uploads/")
+os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)
+
+SEARCH_INDEX_PATH = os.path.join(CACHE_DIRECTORY, "search.sqlite")
+
+BATCH_DIRECTORY = os.path.join(CACHE_DIRECTORY, "batches/")
+os.makedirs(BATCH_DIRECTORY, exist_ok=True)
+
+VARIANT_DIRECTORY = os.path.join(CACHE_DIRECTORY, "variants/")
+os.makedirs(VARIANT_DIRECTORY, exist_ok=True)
+
+SEGMENT_DIRECTORY = os.path.join(CACHE_DIRECTORY, "segments/")
+os.makedirs(SEGMENT_DIRECTORY, exist_ok=True)
+
+JOB_DIRECTORY = os.path.join(CACHE_DIRECTORY, "jobs/")
+os.makedirs(JOB_DIRECTORY, exist_ok=True)
+
+TEXT_STORE_PATH = os.path.join(CACHE_DIRECTORY, "texts.sqlite")
+
 DEFAULT_SUMMARY_PROMPT = """
 You are given a text extracted from a PDF document, which may be highly unstructured. 
 Your task is to rewrite the content in a more structured and coherent form, organizing the information logically and clearly.
@@ -91,6 +333,83 @@ MODEL_OPTIONS = [
 
 MODEL_DEFAULT = MODEL_OPTIONS[0]
 
+MODEL_SPECS = {
+    # costs in USD per 1M tokens, https://platform.openai.com/docs/pricing
+    # context window and max output in tokens, https://platform.openai.com/docs/models
+    # latency (seconds to the first token) and speed (output tokens/s) are rough estimates, only used to rank the models
+    "gpt-4.1-nano-2025-04-14": {
+        "input_cost": 0.10,
+        "output_cost": 0.40,
+        "context": 1_047_576,
+        "max_output": 32_768,
+        "latency": 0.5,
+        "speed": 200,
+    },
+    "gpt-4.1-mini-2025-04-14": {
+        "input_cost": 0.40,
+        "output_cost": 1.60,
+        "context": 1_047_576,
+        "max_output": 32_768,
+        "latency": 0.6,
+        "speed": 120,
+    },
+    "gpt-4.1-2025-04-14": {
+        "input_cost": 2.00,
+        "output_cost": 8.00,
+        "context": 1_047_576,
+        "max_output": 32_768,
+        "latency": 0.8,
+        "speed": 80,
+    },
+    "o3-mini-2025-01-31": {
+        "input_cost": 1.10,
+        "output_cost": 4.40,
+        "context": 200_000,
+        "max_output": 100_000,
+        "latency": 5.0,  # reasoning
+        "speed": 150,
+    },
+    "gpt-4o-2024-11-20": {
+        "input_cost": 2.50,
+        "output_cost": 10.00,
+        "context": 128_000,
+        "max_output": 16_384,
+        "latency": 0.7,
+        "speed": 90,
+    },
+    "gpt-4o-2024-08-06": {
+        "input_cost": 2.50,
+        "output_cost": 10.00,
+        "context": 128_000,
+        "max_output": 16_384,
+        "latency": 0.7,
+        "speed": 90,
+    },
+    "gpt-4o-mini": {
+        "input_cost": 0.15,
+        "output_cost": 0.60,
+        "context": 128_000,
+        "max_output": 16_384,
+        "latency": 0.5,
+        "speed": 120,
+    },
+}
+
+EXPECTED_OUTPUT_TOKENS = (
+    4_000  # for the estimates: summaries and transcripts are a few pages
+)
+
+
+def get_llm_cost(model, input_tokens, output_tokens):
+    """Get the cost of the LLM for the given number of tokens."""
+    if model not in MODEL_SPECS:
+        raise ValueError(f"Unknown model: {model}")
+    specs = MODEL_SPECS[model]
+    return (
+        specs["input_cost"] * input_tokens + specs["output_cost"] * output_tokens
+    ) / 1_000_000
+
+
 TTS_OPTIONS = [
     {
         "model": "tts-1",
@@ -120,6 +439,96 @@ def get_tts_cost(tts_model, n_chars):
     raise ValueError(f"Unknown TTS model: {tts_model}")
 
 
+AUDIO_FORMATS = {  # response_format of the TTS API: label, MIME type and extension of the saved file
+    "mp3": {"label": "MP3", "mimetype": "audio/mpeg", "ext": "mp3"},
+    "opus": {"label": "Opus (smallest)", "mimetype": "audio/ogg", "ext": "opus"},
+    "aac": {"label": "AAC", "mimetype": "audio/aac", "ext": "aac"},
+    "wav": {"label": "WAV (uncompressed)", "mimetype": "audio/wav", "ext": "wav"},
+    "pcm": {"label": "PCM (uncompressed)", "mimetype": "audio/wav", "ext": "wav"},
+}
+AUDIO_FORMAT_DEFAULT = "mp3"
+MIMETYPES = {x["ext"]: x["mimetype"] for x in AUDIO_FORMATS.values()}
+PCM_RATE, PCM_CHANNELS, PCM_BITS = 24_000, 1, 16  # of the "pcm" response_format
+
+
+def wav_header(data_size=0xFFFFFFFF, fmt_chunk=None):
+    """RIFF/WAVE header for data_size bytes of PCM (by default, unknown size, for streaming)."""
+    if fmt_chunk is None:
+        block_align = PCM_CHANNELS * PCM_BITS // 8
+        fmt_chunk = (
+            b"\x01\x00"  # integer PCM
+            + PCM_CHANNELS.to_bytes(2, "little")
+            + PCM_RATE.to_bytes(4, "little")
+            + (PCM_RATE * block_align).to_bytes(4, "little")
+            + block_align.to_bytes(2, "little")
+            + PCM_BITS.to_bytes(2, "little")
+        )
+    riff_size = min(0xFFFFFFFF, 4 + 8 + len(fmt_chunk) + 8 + data_size)
+    return (
+        b"RIFF"
+        + riff_size.to_bytes(4, "little")
+        + b"WAVE"
+        + b"fmt "
+        + len(fmt_chunk).to_bytes(4, "little")
+        + fmt_chunk
+        + b"data"
+        + data_size.to_bytes(4, "little")
+    )
+
+
+def split_wav(data):
+    """Return the fmt chunk and the PCM data of a WAV file.
+    The sizes may be placeholders (when the WAV was streamed): the data runs to the end of the file.
+    """
+    fmt_chunk, offset = None, 12
+    while offset + 8 <= len(data):
+        chunk_id, size = (
+            data[offset : offset + 4],
+            int.from_bytes(data[offset + 4 : offset + 8], "little"),
+        )
+        if chunk_id == b"data":
+            return fmt_chunk, data[offset + 8 : offset + 8 + size]
+        if chunk_id == b"fmt ":
+            fmt_chunk = data[offset + 8 : offset + 8 + size]
+        offset += 8 + size + size % 2
+    raise ValueError("Invalid WAV: no data chunk")
+
+
+def concat_audio(segments, response_format):
+    """Join the audio segments of a dialogue into a single file.
+    MP3 and AAC (ADTS) are sequences of frames, and Opus comes in Ogg, which allows chaining streams,
+    so their segments are just concatenated. WAV needs a single header with the total size,
+    and PCM is saved as WAV too, to be playable.
+    """
+    if response_format == "wav":
+        parts = [split_wav(x) for x in segments]
+        data = b"".join(x[1] for x in parts)
+        return wav_header(len(data), parts[0][0] if parts else None) + data
+    if response_format == "pcm":
+        data = b"".join(segments)
+        return wav_header(len(data)) + data
+    return b"".join(segments)
+
+
+def iter_stream_audio(segments, response_format):
+    """Like concat_audio, but yielding the audio as the segments come, to be streamed:
+    the WAV header is sent first, with an unknown size.
+    """
+    if response_format not in ["wav", "pcm"]:
+        yield from segments
+        return
+
+    header_sent = False
+    for segment in segments:
+        fmt_chunk, data = (
+            split_wav(segment) if response_format == "wav" else (None, segment)
+        )
+        if not header_sent:
+            yield wav_header(fmt_chunk=fmt_chunk)
+            header_sent = True
+        yield data
+
+
 VOICE_OPTIONS = [  # https://platform.openai.com/docs/guides/text-to-speech/quickstart
     dict(value="alloy", label="Alloy - pure neutral"),
     dict(value="echo", label="Echo - emphatic neutral"),
@@ -129,34 +538,319 @@ VOICE_OPTIONS = [  # https://platform.openai.com/docs/guides/text-to-speech/quic
     dict(value="shimmer", label="Shimmer - woman"),
 ]
 
-with open(
-    os.path.join(
-        os.path.dirname(os.path.abspath(__file__)), "assets/showcase_tts_6voices.mp3"
-    ),
-    "rb",
-) as audio_file:
-    DEFAULT_AUDIO_SRC = "data:audio/mp3;base64," + base64.b64encode(
-        audio_file.read()
-    ).decode("utf-8")
+DEFAULT_AUDIO_SRC = "/assets/showcase_tts_6voices.mp3"
+
+
+def store_upload(contents: str) -> str:
+    """Decode the base64 contents of a dcc.Upload and persist them once in UPLOAD_DIRECTORY,
+    named after their content hash. Return the hash, used as handle for the upload.
+    """
+    content_type, content_string = contents.split(",")
+    pdf_data = base64.b64decode(content_string)
+    upload_id = hashlib.sha256(pdf_data).hexdigest()
+    METRICS.inc(
+        "voicemydocs_bytes_total", len(pdf_data), stage="upload", direction="in"
+    )
+    upload_path = get_upload_path(upload_id)
+    if not os.path.exists(upload_path):
+        write_atomic(upload_path, pdf_data)
+    return upload_id
+
+
+def get_upload_path(upload_id: str) -> str:
+    return os.path.join(UPLOAD_DIRECTORY, f"{upload_id}.pdf")
+
+
+def iter_pdf_pages(pdf_source):
+    """Yield the text of a PDF page by page, given either its file path or a (memory-mapped) buffer.
+    Only one page of text is held at a time, so that consumers can start before the last page is parsed.
+    """
+    if isinstance(pdf_source, (str, os.PathLike)):
+        with open(pdf_source, "rb") as pdf_file:
+            with mmap.mmap(pdf_file.fileno(), 0, access=mmap.ACCESS_READ) as pdf_buffer:
+                yield from iter_pdf_pages(pdf_buffer)
+        return
 
+    from PyPDF2 import PdfReader  # imported lazily to keep the startup fast
 
-def extract_text_from_pdf(pdf_data):
-    pdf_reader = PdfReader(io.BytesIO(pdf_data))
+    pdf_reader = PdfReader(pdf_source)
     npages = len(pdf_reader.pages)
-    text = ""
     for npage, page in enumerate(pdf_reader.pages):
-        text += page.extract_text()
+        text = page.extract_text()
         text += f"\n\n>>>>>>>>>>> End Page {npage} of {npages} <<<<<<<<<<<<<\n\n"
-    return text
+        METRICS.inc("voicemydocs_items_total", stage="pdf_extraction")
+        METRICS.inc(
+            "voicemydocs_chars_total",
+            len(text),
+            stage="pdf_extraction",
+            direction="out",
+        )
+        yield text
+
+
+@instrumented("pdf_extraction")
+def extract_text_from_pdf(pdf_source):
+    return "".join(iter_pdf_pages(pdf_source))
+
+
+def iter_text_chunks(pages, max_chars=100_000):
+    """Group an iterable of page texts into chunks of at most max_chars (unless a single page is longer),
+    yielding each chunk as soon as it is complete.
+    """
+    chunk = ""
+    for page in pages:
+        if chunk and len(chunk) + len(page) > max_chars:
+            yield chunk
+            chunk = ""
+        chunk += page
+    if chunk:
+        yield chunk
+
+
+def get_extraction_path(upload_id: str) -> str:
+    return os.path.join(UPLOAD_DIRECTORY, f"{upload_id}.pages.jsonl")
 
 
+def claim_file(path, stale_seconds=None) -> bool:
+    """Create a file exclusively, so that a single thread of a single process does the work it stands for.
+    Return False if the file exists, unless it was not modified for stale_seconds (e.g., its process was killed).
+    """
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        pass
+    try:
+        if (
+            stale_seconds is None
+            or time.time() - os.path.getmtime(path) < stale_seconds
+        ):
+            return False
+        os.remove(path)
+    except FileNotFoundError:
+        pass  # released meanwhile
+    return claim_file(path)
+
+
+EXTRACTION_STALE_SECONDS = 60
+
+
+@instrumented("pdf_extraction")
+def _run_extraction(upload_id):
+    with open(get_extraction_path(upload_id), "w") as extraction_file:
+        try:
+            for page_text in iter_pdf_pages(get_upload_path(upload_id)):
+                extraction_file.write(json.dumps({"text": page_text}) + "\n")
+                extraction_file.flush()
+        except Exception as e:
+            METRICS.inc("voicemydocs_stage_errors_total", stage="pdf_extraction")
+            extraction_file.write(json.dumps({"error": str(e)}) + "\n")
+        extraction_file.write(json.dumps({"done": True}) + "\n")
+
+
+def start_extraction(upload_id):
+    """Extract the pages of an upload in a background thread, appending them to a JSONL file
+    next to the upload. A completed extraction is reused when the same PDF is uploaded again.
+    The file is claimed before, so that only one process extracts the same upload.
+    """
+    if is_extraction_done(upload_id):
+        return
+    if not claim_file(get_extraction_path(upload_id), EXTRACTION_STALE_SECONDS):
+        return
+    threading.Thread(target=_run_extraction, args=(upload_id,), daemon=True).start()
+
+
+def is_extraction_done(upload_id):
+    extraction_path = get_extraction_path(upload_id)
+    if not os.path.exists(extraction_path):
+        return False
+    done_line = (json.dumps({"done": True}) + "\n").encode()
+    with open(extraction_path, "rb") as extraction_file:
+        extraction_file.seek(max(0, os.path.getsize(extraction_path) - len(done_line)))
+        return extraction_file.read() == done_line
+
+
+def read_extracted_pages(upload_id, offset=0):
+    """Read the pages extracted so far, starting from the byte offset of the previous read.
+    Return the new text, the new offset and whether the extraction is complete.
+    """
+    text, done = "", False
+    if not os.path.exists(get_extraction_path(upload_id)):  # extraction not started yet
+        return text, offset, done
+    with open(get_extraction_path(upload_id), "rb") as extraction_file:
+        extraction_file.seek(offset)
+        for line in extraction_file:
+            if not line.endswith(b"\n"):  # page still being written
+                break
+            offset += len(line)
+            record = json.loads(line)
+            if "text" in record:
+                text += record["text"]
+            elif "error" in record:
+                text += f"\n\nERROR while extracting the text: {record['error']}\n\n"
+            elif record.get("done"):
+                done = True
+    return text, offset, done
+
+
+def iter_extraction_pages(upload_id, poll_interval=0.2, timeout=600):
+    """Yield the text extracted from an upload as it arrives, from the first page until the extraction is complete."""
+    offset, deadline = 0, time.time() + timeout
+    while True:
+        text, offset, done = read_extracted_pages(upload_id, offset)
+        if text:
+            yield text
+        if done:
+            return
+        if time.time() > deadline:
+            raise RuntimeError(f"The extraction of {upload_id} stalled")
+        time.sleep(poll_interval)
+
+
+PAGE_SEPARATOR_REGEX = re.compile(
+    r"(\n\n>>>>>>>>>>> End Page \d+ of \d+ <<<<<<<<<<<<<\n\n)"
+)
+PAGE_NUMBER_REGEX = re.compile(
+    r"^(page\s*)?[-–—]?\s*\d{1,4}\s*[-–—]?(\s*(of|/)\s*\d{1,4})?$", re.IGNORECASE
+)
+REFERENCES_HEADING_REGEX = re.compile(
+    r"^(\d+\.?\s*)?(references|bibliography|works cited|literature cited)\s*:?$",
+    re.IGNORECASE,
+)
+
+PREPROCESS_OPTIONS = [
+    dict(value="headers-footers", label="Remove running headers and footers"),
+    dict(value="page-numbers", label="Remove page numbers"),
+    dict(value="dehyphenate", label="Join words hyphenated across lines"),
+    dict(value="references", label="Strip the references section"),
+    dict(value="whitespace", label="Normalize whitespace"),
+]
+
+PREPROCESS_DEFAULT = ["headers-footers", "page-numbers", "dehyphenate", "whitespace"]
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough estimate of the number of tokens, assuming ~4 characters per token as for English text."""
+    return (len(text) + 3) // 4
+
+
+def _page_edges(lines, nlines):
+    """Return the first and last nlines of a page (fewer for short pages, where they would cover the body)."""
+    nlines = min(nlines, max(1, len(lines) // 4))
+    return lines[:nlines] + lines[-nlines:]
+
+
+def _is_page_edge(iline, lines, nlines):
+    nlines = min(nlines, max(1, len(lines) // 4))
+    return iline < nlines or iline >= len(lines) - nlines
+
+
+def _remove_headers_footers(pages, nlines=3, min_ratio=0.5):
+    """Remove the lines that repeat among the first or last nlines of most pages,
+    ignoring the digits (e.g., 'Journal of X, vol. 3, page 12')."""
+
+    def normalize(line):
+        return re.sub(r"\d+", "#", line.strip())
+
+    counts = Counter()
+    for lines in pages:
+        counts.update({normalize(line) for line in _page_edges(lines, nlines)})
+    counts.pop("", None)
+    min_pages = max(2, int(min_ratio * len(pages)))
+    repeated = {key for key, count in counts.items() if count >= min_pages}
+
+    if not repeated:
+        return pages
+    return [
+        [
+            line
+            for iline, line in enumerate(lines)
+            if not (_is_page_edge(iline, lines, nlines) and normalize(line) in repeated)
+        ]
+        for lines in pages
+    ]
+
+
+def _remove_page_numbers(pages, nlines=2):
+    """Remove the lines containing only a page number among the first or last nlines of each page."""
+    return [
+        [
+            line
+            for iline, line in enumerate(lines)
+            if not (
+                _is_page_edge(iline, lines, nlines)
+                and PAGE_NUMBER_REGEX.match(line.strip())
+            )
+        ]
+        for lines in pages
+    ]
+
+
+def _remove_references(pages):
+    """Remove everything after the last references heading, if it is found in the second half of the document."""
+    for ipage in range(len(pages) - 1, len(pages) // 2 - 1, -1):
+        lines = pages[ipage]
+        for iline in range(len(lines) - 1, -1, -1):
+            if REFERENCES_HEADING_REGEX.match(lines[iline].strip()):
+                return (
+                    pages[:ipage] + [lines[:iline]] + [[] for _ in pages[ipage + 1 :]]
+                )
+    return pages
+
+
+def preprocess_text(text: str, steps=PREPROCESS_DEFAULT):
+    """Clean the text extracted from a PDF before it is sent to the LLM, applying the given steps
+    (see PREPROCESS_OPTIONS). The page separators are preserved.
+    Return the cleaned text and a dictionary with the characters and tokens saved.
+    """
+    parts = PAGE_SEPARATOR_REGEX.split(text)
+    pages = [part.split("\n") for part in parts[::2]]
+    separators = parts[1::2]
+
+    if "headers-footers" in steps:
+        pages = _remove_headers_footers(pages)
+    if "page-numbers" in steps:
+        pages = _remove_page_numbers(pages)
+    if "references" in steps:
+        pages = _remove_references(pages)
+
+    pages = ["\n".join(lines) for lines in pages]
+    if "dehyphenate" in steps:
+        pages = [re.sub(r"(\w)-\n\s*([a-z])", r"\1\2", page) for page in pages]
+    if "whitespace" in steps:
+        pages = [re.sub(r"[ \t\f\v]+", " ", page) for page in pages]
+        pages = [re.sub(r" ?\n ?", "\n", page) for page in pages]
+        pages = [re.sub(r"\n{3,}", "\n\n", page).strip() for page in pages]
+
+    cleaned_text = pages[0]
+    for separator, page in zip(separators, pages[1:]):
+        cleaned_text += separator + page
+
+    stats = {
+        "chars_before": len(text),
+        "chars_after": len(cleaned_text),
+        "chars_saved": len(text) - len(cleaned_text),
+        "tokens_saved": estimate_tokens(text) - estimate_tokens(cleaned_text),
+    }
+    return cleaned_text, stats
+
+
+@instrumented("llm")
 def call_llm_api(system_content, user_content, model, api_keys):
     """Call the OpenAI API to get the response from the LLM."""
 
     if not api_keys["openai"]:
         return "Please insert your OpenAI API Key first..."
 
+    from openai import OpenAI  # imported lazily to keep the startup fast
+
     client = OpenAI(api_key=api_keys["openai"])
+    METRICS.inc(
+        "voicemydocs_chars_total",
+        len(system_content or "") + len(user_content or ""),
+        stage="llm",
+        direction="in",
+    )
 
     completion = client.chat.completions.create(
         model=model,
@@ -168,22 +862,281 @@ def call_llm_api(system_content, user_content, model, api_keys):
     )
 
     output_content = completion.choices[0].message.content
+    METRICS.inc(
+        "voicemydocs_chars_total",
+        len(output_content or ""),
+        stage="llm",
+        direction="out",
+    )
 
     return output_content
 
 
-def call_tts_api(text: str, voice: str, tts_model: str, api_key: str) -> bytes:
+def run_variant(system_content, user_content, model, api_keys):
+    """Call the LLM and measure the latency, length and (estimated) cost of the response."""
+    start = time.perf_counter()
+    try:
+        text, error = call_llm_api(system_content, user_content, model, api_keys), None
+    except Exception as e:
+        text, error = "", repr(e)
+    input_tokens = estimate_tokens(system_content or "") + estimate_tokens(user_content)
+    output_tokens = estimate_tokens(text or "")
+    return {
+        "prompt": system_content,
+        "model": model,
+        "text": text,
+        "error": error,
+        "seconds": round(time.perf_counter() - start, 3),
+        "chars": len(text or ""),
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cost": get_llm_cost(model, input_tokens, output_tokens),
+    }
+
+
+def run_variants(prompts, models, user_content, api_keys, max_workers=8):
+    """Run every (prompt, model) variant on the same input concurrently, returning the results in order."""
+    with cf.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(run_variant, prompt, user_content, model, api_keys)
+            for prompt in prompts
+            for model in models
+        ]
+        return [future.result() for future in futures]
+
+
+def save_variants(step, input_text, results):
+    """Write the results of a fan-out as sibling drafts in VARIANT_DIRECTORY/group/,
+    with the shared input in input.json, and return the name of the group.
+    The name is unique, also for the fan-outs of other sessions in the same second.
+    """
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    group = f"{timestamp}_{step}_{os.urandom(4).hex()}"
+    group_directory = os.path.join(VARIANT_DIRECTORY, group)
+    os.makedirs(group_directory)
+
+    with open(os.path.join(group_directory, "input.json"), "w") as input_file:
+        json.dump({"step": step, "input-text": input_text}, input_file, indent=4)
+    for index, result in enumerate(results):
+        with open(
+            os.path.join(group_directory, f"{index:02d}.json"), "w"
+        ) as variant_file:
+            json.dump(result, variant_file, indent=4)
+    return group
+
+
+def load_variant(group, index):
+    if os.path.basename(group) != group:  # the group comes from the browser
+        raise ValueError(f"Invalid variant group {group}")
+    with open(
+        os.path.join(VARIANT_DIRECTORY, group, f"{index:02d}.json")
+    ) as variant_file:
+        return json.load(variant_file)
+
+
+def estimate_llm_call(model, input_tokens, output_tokens=EXPECTED_OUTPUT_TOKENS):
+    """Estimate whether a request fits the context of the model, and its cost and duration."""
+    specs = MODEL_SPECS[model]
+    output_tokens = min(output_tokens, specs["max_output"])
+    return {
+        "model": model,
+        "fits": input_tokens + output_tokens <= specs["context"],
+        "cost": get_llm_cost(model, input_tokens, output_tokens),
+        "seconds": specs["latency"] + output_tokens / specs["speed"],
+    }
+
+
+def split_text_chunks(text, max_chars):
+    """Split a text in chunks of at most max_chars, at the page boundaries if possible."""
+    parts = PAGE_SEPARATOR_REGEX.split(text)
+    pages = [a + b for a, b in zip(parts[::2], parts[1::2] + [""])]
+    chunks = []
+    for chunk in iter_text_chunks(pages, max_chars):
+        chunks += [chunk[i : i + max_chars] for i in range(0, len(chunk), max_chars)]
+    return chunks
+
+
+def get_chunk_chars(model, prompt_tokens):
+    """Maximum characters of a chunk of input, so that a request with it fits the context of the model."""
+    specs = MODEL_SPECS[model]
+    output_tokens = min(EXPECTED_OUTPUT_TOKENS, specs["max_output"])
+    return 4 * ((specs["context"] - prompt_tokens - output_tokens) * 9 // 10)  # margin
+
+
+def preflight(prompt, input_text, model, budget=None, route=False, chunk=True):
+    """Plan an LLM request before sending it: estimate the tokens of prompt and input,
+    and the cost and duration of the request with the given model, or, if route is True,
+    with the fastest model costing less than budget (USD), falling back to the given one.
+    If the input exceeds the context of the model, it is split in chunks that are processed separately
+    and merged by a final request (unless chunk is False, then the plan is rejected).
+    Return the plan as a dict, with "error" if rejected.
+    """
+    prompt_tokens = estimate_tokens(prompt or "")
+    input_tokens = prompt_tokens + estimate_tokens(input_text)
+
+    if route:
+        candidates = [estimate_llm_call(x, input_tokens) for x in MODEL_SPECS]
+        candidates = [
+            x
+            for x in candidates
+            if x["fits"] and (budget is None or x["cost"] <= budget)
+        ]
+        if candidates:
+            model = min(candidates, key=lambda x: x["seconds"])["model"]
+
+    plan = estimate_llm_call(model, input_tokens)
+    plan.update(input_tokens=input_tokens, chunks=[input_text])
+    if plan["fits"]:
+        return plan
+    if not chunk:
+        return dict(
+            plan,
+            error=f"The input (~{input_tokens} tokens) exceeds the context of {model}",
+        )
+
+    specs = MODEL_SPECS[model]
+    output_tokens = min(EXPECTED_OUTPUT_TOKENS, specs["max_output"])
+    chunks = split_text_chunks(input_text, get_chunk_chars(model, prompt_tokens))
+    estimates = [
+        estimate_llm_call(model, prompt_tokens + estimate_tokens(x)) for x in chunks
+    ]
+    merge = estimate_llm_call(model, prompt_tokens + len(chunks) * output_tokens)
+    plan.update(
+        fits=True,
+        chunks=chunks,
+        cost=sum(x["cost"] for x in estimates) + merge["cost"],
+        seconds=max(x["seconds"] for x in estimates) + merge["seconds"],  # in parallel
+    )
+    return plan
+
+
+def describe_plan(plan):
+    """Summarize a preflight plan in one line, for the user."""
+    if "error" in plan:
+        return plan["error"]
+    chunks = f" in {len(plan['chunks'])} chunks" if len(plan["chunks"]) > 1 else ""
+    return (
+        f"~{plan['input_tokens']} tokens in, ~${plan['cost']:.4f}, ~{plan['seconds']:.0f}s "
+        f"with {plan['model']}{chunks}"
+    )
+
+
+def call_llm_chunks(chunks, prompt, model, api_keys):
+    """One request per chunk, sent as soon as the chunk is available (chunks can be a generator,
+    e.g., of a document still being extracted), and a final one merging their outputs, if more than one.
+    """
+    with cf.ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [
+            executor.submit(call_llm_api, prompt, x, model, api_keys) for x in chunks
+        ]
+        partials = [x.result() for x in futures]
+    if len(partials) == 1:
+        return partials[0]
+
+    merged_input = "\n\n".join(
+        f"Part {i + 1} of {len(partials)}:\n{x}" for i, x in enumerate(partials)
+    )
+    return call_llm_api(prompt, merged_input, model, api_keys)
+
+
+def call_llm_planned(plan, prompt, api_keys):
+    """Execute a preflight plan: a single request, or one per chunk and a final one merging their outputs."""
+    return call_llm_chunks(plan["chunks"], prompt, plan["model"], api_keys)
+
+
+@instrumented("tts_segment")
+def call_tts_api(
+    text: str,
+    voice: str,
+    tts_model: str,
+    api_key: str,
+    response_format: str = AUDIO_FORMAT_DEFAULT,
+) -> bytes:
+    from openai import OpenAI  # imported lazily to keep the startup fast
+
     client = OpenAI(api_key=api_key)
+    METRICS.inc(
+        "voicemydocs_chars_total", len(text), stage="tts_segment", direction="in"
+    )
 
     with client.audio.speech.with_streaming_response.create(
         model=tts_model,
         voice=voice,
         input=text,
+        response_format=response_format,
     ) as response:
         with io.BytesIO() as file:
             for chunk in response.iter_bytes():
                 file.write(chunk)
-            return file.getvalue()  # Mp3
+            METRICS.inc(
+                "voicemydocs_bytes_total",
+                file.tell(),
+                stage="tts_segment",
+                direction="out",
+            )
+            return file.getvalue()  # in response_format
+
+
+SPEAKER_TAG_REGEX = re.compile(r"<([^<>]+)>")
+INLINE_SPEAKER_TAG_REGEX = re.compile(r"<([^<>]+)>\s*(.+)")
+DEFAULT_SPEAKER_TAG_REGEX = re.compile(r"speaker\d+", re.IGNORECASE)
+SPEAKER_NAME_REGEX = re.compile(r"[A-Z][\w.'-]*(?: [A-Z][\w.'-]*){0,3}")
+
+DIALOGUE_CACHE_SIZE = 32
+DIALOGUE_CACHE = OrderedDict()
+DIALOGUE_CACHE_LOCK = threading.Lock()
+
+
+def iter_dialogue(dialogue: str):
+    """Parse a dialogue in a single pass, yielding a (speaker_index, text) tuple for each line of text.
+    Speakers are numbered from 1 in order of appearance. A speaker tag is on its own line, e.g., '<Alice>\nHello',
+    or inline, e.g., '<Alice> Hello', if it is a speaker already tagged, '<speakerN>' or looks like a name
+    (capitalized words): other inline tags, e.g., '<laughs> Funny', are part of the text.
+    Text before the first speaker tag is skipped.
+    """
+    speakers = {}
+    speaker_index = None
+    for match in re.finditer(r"[^\n]+", dialogue):
+        line = match.group().strip()
+        if not line:
+            continue
+        tag_match = SPEAKER_TAG_REGEX.fullmatch(line)
+        if tag_match:
+            speaker = tag_match.group(1).strip()
+            speaker_index = speakers.setdefault(speaker, len(speakers) + 1)
+            continue
+        inline_match = INLINE_SPEAKER_TAG_REGEX.match(line)
+        if inline_match:
+            speaker = inline_match.group(1).strip()
+            if (
+                speaker in speakers
+                or DEFAULT_SPEAKER_TAG_REGEX.fullmatch(speaker)
+                or SPEAKER_NAME_REGEX.fullmatch(speaker)
+            ):
+                speaker_index = speakers.setdefault(speaker, len(speakers) + 1)
+                line = inline_match.group(2)
+        if speaker_index is None:
+            continue
+        yield speaker_index, line
+
+
+def parse_dialogue(dialogue: str) -> tuple:
+    """Return the tuple of (speaker_index, text) from iter_dialogue, memoized by the hash of the text,
+    so that the callbacks working on the same transcript parse it only once.
+    """
+    key = hashlib.sha1(dialogue.encode()).hexdigest()
+    with DIALOGUE_CACHE_LOCK:
+        if key in DIALOGUE_CACHE:
+            DIALOGUE_CACHE.move_to_end(key)
+            return DIALOGUE_CACHE[key]
+
+    turns = tuple(iter_dialogue(dialogue))
+
+    with DIALOGUE_CACHE_LOCK:
+        DIALOGUE_CACHE[key] = turns
+        if len(DIALOGUE_CACHE) > DIALOGUE_CACHE_SIZE:
+            DIALOGUE_CACHE.popitem(last=False)
+    return turns
 
 
 def dialogue_text2list(dialogue: str) -> list:
@@ -193,23 +1146,254 @@ def dialogue_text2list(dialogue: str) -> list:
     ...]
     """
 
-    lines = [line.strip() for line in dialogue.strip().split("\n") if line.strip()]
-    dialogue_list = []
-    speakers = []
-
-    # Iterate through the lines
-    for line in lines:
-        if line.strip().startswith("<") and line.strip().endswith(">"):
-            current_speaker = line.strip()
-            if line not in speakers:
-                speakers.append(line)
-        elif len(speakers) > 0:
-            speaker_index = speakers.index(current_speaker) + 1
-            dialogue_list.append({"speaker": speaker_index, "text": line})
-        else:
-            continue
+    return [
+        {"speaker": speaker_index, "text": text}
+        for speaker_index, text in parse_dialogue(dialogue)
+    ]
+
+
+def get_segment_key(text, voice, tts_model, response_format=AUDIO_FORMAT_DEFAULT):
+    """Content address of the audio of a dialogue turn."""
+    segment = [tts_model, voice, text, response_format]
+    return hashlib.sha256(json.dumps(segment).encode()).hexdigest()
+
+
+def get_segment_path(segment_key, response_format=AUDIO_FORMAT_DEFAULT):
+    return os.path.join(SEGMENT_DIRECTORY, f"{segment_key}.{response_format}")
+
+
+SEGMENT_LOCK_STALE_SECONDS = 300
+
+
+def synthesize_segment(
+    text, voice, tts_model, api_key, response_format=AUDIO_FORMAT_DEFAULT
+):
+    """Synthesize a dialogue turn into the segment store, unless it is already there, and return its key.
+    If the same segment is being synthesized by another thread or process (e.g., a speculation),
+    i.e., its lock file exists, wait for it instead.
+    """
+    segment_key = get_segment_key(text, voice, tts_model, response_format)
+    segment_path = get_segment_path(segment_key, response_format)
+    lock_path = f"{segment_path}.lock"
+    while True:
+        if os.path.exists(segment_path):
+            METRICS.inc("voicemydocs_cache_total", cache="segments", result="hit")
+            return segment_key
+        if claim_file(lock_path, SEGMENT_LOCK_STALE_SECONDS):
+            break
+        time.sleep(0.05)  # then check again: it may have failed
+
+    try:
+        if os.path.exists(segment_path):  # completed just before the lock was claimed
+            METRICS.inc("voicemydocs_cache_total", cache="segments", result="hit")
+            return segment_key
+        METRICS.inc("voicemydocs_cache_total", cache="segments", result="miss")
+        audio_data = call_tts_api(text, voice, tts_model, api_key, response_format)
+        write_atomic(segment_path, audio_data)
+    finally:
+        os.remove(lock_path)
+    return segment_key
+
+
+def get_dialogue_segments(
+    dialogue_text, speakers_voice, tts_model, response_format=AUDIO_FORMAT_DEFAULT
+):
+    """Return the (text, voice, model, format) of each turn of a dialogue, i.e., what defines its audio segment.
+    Raise ValueError if the dialogue has more speakers than voices.
+    """
+    turns = dialogue_text2list(dialogue_text)
+    n_speakers = max((x["speaker"] for x in turns), default=0)
+    if n_speakers > len(speakers_voice):
+        raise ValueError(
+            f"The transcript has {n_speakers} speakers, but only {len(speakers_voice)} voices: "
+            f"tag at most {len(speakers_voice)} speakers."
+        )
+    return [
+        (x["text"], speakers_voice[x["speaker"] - 1], tts_model, response_format)
+        for x in turns
+    ]
+
+
+def get_project_audio_path(name):
+    """Path of the audio of a project, in any of the AUDIO_FORMATS, or None if missing."""
+    for ext in dict.fromkeys(x["ext"] for x in AUDIO_FORMATS.values()):
+        audio_file_path = os.path.join(CACHE_DIRECTORY, f"{name}.{ext}")
+        if os.path.exists(audio_file_path):
+            return audio_file_path
+    return None
+
+
+def get_job_path(job_id, ext="json"):
+    return os.path.join(JOB_DIRECTORY, f"{job_id}.{ext}")
+
+
+TTS_JOBS_RUNNING = set()
+TTS_JOBS_LOCK = threading.Lock()
+
+
+@instrumented("compile_dialogue")
+def _run_tts_job(job_id, segments, api_key):
+    try:
+        with cf.ThreadPoolExecutor() as executor:  # submitted in order: the first turns are ready first
+            futures = [
+                executor.submit(
+                    synthesize_segment, text, voice, tts_model, api_key, fmt
+                )
+                for text, voice, tts_model, fmt in segments
+            ]
+            for future in futures:
+                future.result()
+    except Exception as e:
+        with open(get_job_path(job_id, "error"), "w") as error_file:
+            error_file.write(repr(e))
+        raise
+    finally:
+        with TTS_JOBS_LOCK:
+            TTS_JOBS_RUNNING.discard(job_id)
+
+
+def start_tts_job(
+    dialogue_text,
+    speakers_voice=["nova", "echo", "onyx"],
+    tts_model=TTS_DEFAULT["model"],
+    api_key=None,
+    response_format=AUDIO_FORMAT_DEFAULT,
+):
+    """Write the manifest of the audio of a dialogue (the ordered keys of its segments) and synthesize
+    the missing segments in background. Return the job id, i.e., the hash of the manifest,
+    so the same dialogue with the same voices (and format) is a single job, and its audio is read by iter_job_audio.
+    """
+    segments = get_dialogue_segments(
+        dialogue_text, speakers_voice, tts_model, response_format
+    )
+    METRICS.inc("voicemydocs_items_total", len(segments), stage="compile_dialogue")
+
+    segment_keys = [get_segment_key(*segment) for segment in segments]
+    manifest = {"segments": segment_keys, "format": response_format}
+    job_id = hashlib.sha256(json.dumps(manifest).encode()).hexdigest()
+
+    with TTS_JOBS_LOCK:
+        if job_id in TTS_JOBS_RUNNING:
+            return job_id
+        TTS_JOBS_RUNNING.add(job_id)
+
+    # the manifest is addressed by its content: written once, then only read
+    if not os.path.exists(get_job_path(job_id)):
+        write_atomic(get_job_path(job_id), json.dumps(manifest))
+    if os.path.exists(get_job_path(job_id, "error")):
+        os.remove(get_job_path(job_id, "error"))  # a new attempt
+
+    threading.Thread(
+        target=_run_tts_job, args=(job_id, segments, api_key), daemon=True
+    ).start()
+    return job_id
 
-    return dialogue_list
+
+def get_speculation_path(session_id):
+    # the session id comes from the browser: hashed to be a safe file name
+    session_hash = hashlib.sha256(str(session_id).encode()).hexdigest()
+    return os.path.join(JOB_DIRECTORY, f"{session_hash}.speculation")
+
+
+def get_job_texts_path(session_id, job_id):
+    # the texts of a session as of its request of a job, saved with its audio
+    key = hashlib.sha256(f"{session_id}/{job_id}".encode()).hexdigest()
+    return os.path.join(JOB_DIRECTORY, f"{key}.texts")
+
+
+def cancel_speculation(session_id) -> str:
+    """Stop the speculation of a session (before its next segment), returning the new generation.
+    The generation is in a file, so that a speculation running in another process is stopped too.
+    """
+    generation = os.urandom(8).hex()
+    write_atomic(get_speculation_path(session_id), generation)
+    return generation
+
+
+def is_speculation_current(session_id, generation) -> bool:
+    try:
+        with open(get_speculation_path(session_id)) as speculation_file:
+            return speculation_file.read() == generation
+    except FileNotFoundError:
+        return False
+
+
+def _run_speculation(session_id, generation, segments, api_key, delay):
+    failed = threading.Event()
+
+    def synthesize(text, voice, tts_model, response_format):
+        if is_speculation_current(session_id, generation) and not failed.is_set():
+            try:
+                synthesize_segment(text, voice, tts_model, api_key, response_format)
+            except Exception:
+                failed.set()  # best effort: the job will retry
+                return
+            METRICS.inc("voicemydocs_items_total", stage="tts_speculation")
+
+    time.sleep(delay)  # let the settings and the edits settle
+    if not is_speculation_current(session_id, generation):
+        return
+    with cf.ThreadPoolExecutor(max_workers=4) as executor:
+        for segment in segments:
+            executor.submit(synthesize, *segment)
+
+
+def speculate_tts(
+    session_id,
+    dialogue_text,
+    speakers_voice,
+    tts_model,
+    api_key,
+    response_format=AUDIO_FORMAT_DEFAULT,
+    delay=2.0,
+):
+    """Synthesize the segments of a dialogue in background, so that they are in the segment store
+    when the audio is requested. Any previous speculation of the session is cancelled.
+    """
+    generation = cancel_speculation(session_id)
+    segments = get_dialogue_segments(
+        dialogue_text, speakers_voice, tts_model, response_format
+    )
+    threading.Thread(
+        target=_run_speculation,
+        args=(session_id, generation, segments, api_key, delay),
+        daemon=True,
+    ).start()
+
+
+def get_job_format(job_id):
+    with open(get_job_path(job_id)) as job_file:
+        return json.load(job_file).get("format", AUDIO_FORMAT_DEFAULT)
+
+
+def wait_tts_job(job_id):
+    """Wait until all the segments of a job are synthesized, and return their keys."""
+    for _ in iter_job_audio(job_id):
+        pass
+    with open(get_job_path(job_id)) as job_file:
+        return json.load(job_file)["segments"]
+
+
+def iter_job_audio(job_id, poll_interval=0.05, timeout=600):
+    """Yield the audio of a job segment by segment, in order, as soon as each one is synthesized.
+    Raise RuntimeError if the job failed or stalled.
+    """
+    with open(get_job_path(job_id)) as job_file:
+        job = json.load(job_file)
+
+    for segment_key in job["segments"]:
+        segment_path = get_segment_path(
+            segment_key, job.get("format", AUDIO_FORMAT_DEFAULT)
+        )
+        deadline = time.time() + timeout
+        while not os.path.exists(segment_path):
+            if os.path.exists(get_job_path(job_id, "error")):
+                raise RuntimeError(f"The synthesis of the audio {job_id} failed")
+            if time.time() > deadline:
+                raise RuntimeError(f"The synthesis of the audio {job_id} stalled")
+            time.sleep(poll_interval)
+        with open(segment_path, "rb") as segment_file:
+            yield segment_file.read()
 
 
 def compile_dialogue(
@@ -217,31 +1401,427 @@ def compile_dialogue(
     speakers_voice=["nova", "echo", "onyx"],
     tts_model=TTS_DEFAULT["model"],
     api_key=None,
+    response_format=AUDIO_FORMAT_DEFAULT,
 ):
     """Inspired to PDF2Audio"""
+    job_id = start_tts_job(
+        dialogue_text, speakers_voice, tts_model, api_key, response_format
+    )
+    return concat_audio(iter_job_audio(job_id), response_format)
+
+
+TEXT_STEPS = ["file", "summary", "transcript"]
+
+
+class TextStore:
+    """Canonical text of each step (file, summary, transcript) for each browser session, kept server-side.
 
-    dialogue_list = dialogue_text2list(dialogue_text)
-
-    audio = b""
-    with cf.ThreadPoolExecutor() as executor:
-        futures = []
-        counter = 0
-        for dialogue_dict in dialogue_list:
-            counter += 1
-            future = executor.submit(
-                call_tts_api,
-                dialogue_dict["text"],
-                speakers_voice[dialogue_dict["speaker"] - 1],
-                tts_model,
-                api_key,
+    The text is versioned: the browser sends its edits as a diff from the last version it received
+    (see apply_diff), and the server sends new texts once (see set and append),
+    so that the callbacks exchange keys and diffs instead of whole documents.
+    A session is created by register: if the server does not know it (e.g., it restarted, or it was evicted),
+    its texts are lost until the browser sends them again (see is_lost).
+    """
+
+    def __init__(self, max_sessions=256, max_history=8):
+        self.max_sessions = max_sessions
+        self.max_history = max_history
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+
+    def _entry(self, session_id, step, lost=True):
+        """Return the entry of a step, creating the session if needed (call with the lock acquired)."""
+        if session_id not in self._sessions:
+            self._sessions[session_id] = {
+                x: {
+                    "version": 0,
+                    "history": {0: ""},
+                    "cid": 0,
+                    "pushed": 0,
+                    "lost": lost,
+                }
+                for x in TEXT_STEPS
+            }
+            if len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        self._sessions.move_to_end(session_id)
+        return self._sessions[session_id][step]
+
+    def _add_version(self, entry, text):
+        entry["version"] += 1
+        entry["history"][entry["version"]] = text
+        for version in sorted(entry["history"])[: -self.max_history]:
+            del entry["history"][version]
+        return entry["version"]
+
+    def register(self, session_id):
+        """Create a new session, with empty texts."""
+        with self._lock:
+            self._entry(session_id, TEXT_STEPS[0], lost=False)
+
+    def is_lost(self, session_id, step) -> bool:
+        """Whether the server does not know the text of a step that the browser may have."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return session is None or session[step]["lost"]
+
+    def get(self, session_id, step):
+        with self._lock:
+            if session_id not in self._sessions:
+                return ""
+            entry = self._entry(session_id, step)
+            return entry["history"][entry["version"]]
+
+    def set(self, session_id, step, text) -> int:
+        """Replace the text of a step, returning its new version."""
+        with self._lock:
+            entry = self._entry(session_id, step)
+            entry["pushed"] = self._add_version(entry, text or "")
+            entry["lost"] = False
+            return entry["pushed"]
+
+    def append(self, session_id, step, text) -> int:
+        with self._lock:
+            entry = self._entry(session_id, step)
+            text = entry["history"][entry["version"]] + text
+            entry["pushed"] = self._add_version(entry, text)
+            return entry["pushed"]
+
+    def apply_diff(self, session_id, step, diff) -> dict:
+        """Apply a diff sent by the browser, i.e., the replacement of base_text[start:end] with text,
+        where base_text is the version the browser last received (or an empty text if base is -1).
+        Diffs are numbered by the browser (cid): the older ones arriving late, and the ones based on a version
+        preceding the last text sent by the server (which replaced them in the browser), are ignored (returning None).
+        Return the acknowledgement for the browser, asking for the full text if the base version is lost.
+        """
+        with self._lock:
+            entry = self._entry(session_id, step)
+            if diff["cid"] <= entry["cid"] or 0 <= diff["base"] < entry["pushed"]:
+                return None
+            base_text = "" if diff["base"] < 0 else entry["history"].get(diff["base"])
+            if base_text is None:
+                return {"cid": diff["cid"], "resync": True}
+
+            text = base_text[: diff["start"]] + diff["text"] + base_text[diff["end"] :]
+            entry["cid"] = diff["cid"]
+            entry["lost"] = False  # the text is the one of the browser
+            for version in [x for x in entry["history"] if x < diff["base"]]:
+                del entry["history"][version]  # the browser moved past these versions
+            return {"cid": diff["cid"], "version": self._add_version(entry, text)}
+
+
+class SQLiteTextStore:
+    """TextStore in a SQLite database, shared by the processes of a server (see voicemydocs serve),
+    so that the requests of a session can be served by any of them. Same interface and semantics.
+    """
+
+    def __init__(self, path, max_sessions=256, max_history=8):
+        self.path = path
+        self.max_sessions = max_sessions
+        self.max_history = max_history
+        self._local = threading.local()
+        with contextlib.closing(sqlite3.connect(path, timeout=30)) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")  # the readers do not wait
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS steps (
+                    session TEXT, step TEXT, version INTEGER, cid INTEGER, pushed INTEGER, atime REAL,
+                    lost INTEGER,
+                    PRIMARY KEY (session, step)
+                );
+                CREATE TABLE IF NOT EXISTS texts (
+                    session TEXT, step TEXT, version INTEGER, text TEXT,
+                    PRIMARY KEY (session, step, version)
+                );
+                """
+            )
+
+    def _connect(self):
+        """A connection for each thread of each process (i.e., not inherited by a fork)."""
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._local.connection = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None
+            )
+            self._local.connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")  # a single writer, from the first read
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _entry(self, connection, session_id, step, lost=True):
+        """Return the version, cid and pushed version of a step, creating the session if needed."""
+        now = time.time()
+        updated = connection.execute(
+            "UPDATE steps SET atime = ? WHERE session = ?", (now, session_id)
+        ).rowcount
+        if not updated:
+            connection.executemany(
+                "INSERT INTO steps VALUES (?, ?, 0, 0, 0, ?, ?)",
+                [(session_id, x, now, lost) for x in TEXT_STEPS],
+            )
+            connection.executemany(
+                "INSERT INTO texts VALUES (?, ?, 0, '')",
+                [(session_id, x) for x in TEXT_STEPS],
             )
-            futures.append(future)
+            evicted = connection.execute(
+                "SELECT session FROM steps GROUP BY session ORDER BY MAX(atime) DESC LIMIT -1 OFFSET ?",
+                (self.max_sessions,),
+            ).fetchall()
+            for table in ["steps", "texts"]:
+                connection.executemany(
+                    f"DELETE FROM {table} WHERE session = ?", evicted
+                )
+        return connection.execute(
+            "SELECT version, cid, pushed FROM steps WHERE session = ? AND step = ?",
+            (session_id, step),
+        ).fetchone()
+
+    def _add_version(self, connection, session_id, step, version, text):
+        version += 1
+        connection.execute(
+            "INSERT INTO texts VALUES (?, ?, ?, ?)", (session_id, step, version, text)
+        )
+        connection.execute(
+            "DELETE FROM texts WHERE session = ? AND step = ? AND version <= ?",
+            (session_id, step, version - self.max_history),
+        )
+        connection.execute(
+            "UPDATE steps SET version = ? WHERE session = ? AND step = ?",
+            (version, session_id, step),
+        )
+        return version
+
+    def _get_text(self, connection, session_id, step, version):
+        row = connection.execute(
+            "SELECT text FROM texts WHERE session = ? AND step = ? AND version = ?",
+            (session_id, step, version),
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def register(self, session_id):
+        with self._transaction() as connection:
+            self._entry(connection, session_id, TEXT_STEPS[0], lost=False)
+
+    def is_lost(self, session_id, step) -> bool:
+        row = (
+            self._connect()
+            .execute(
+                "SELECT lost FROM steps WHERE session = ? AND step = ?",
+                (session_id, step),
+            )
+            .fetchone()
+        )
+        return row is None or bool(row[0])
+
+    def get(self, session_id, step):
+        row = (
+            self._connect()
+            .execute(
+                "SELECT text FROM texts NATURAL JOIN steps WHERE session = ? AND step = ?",
+                (session_id, step),
+            )
+            .fetchone()
+        )
+        return "" if row is None else row[0]
+
+    def _push(self, session_id, step, text, append):
+        with self._transaction() as connection:
+            version, _, _ = self._entry(connection, session_id, step)
+            if append:
+                text = self._get_text(connection, session_id, step, version) + text
+            version = self._add_version(connection, session_id, step, version, text)
+            connection.execute(
+                "UPDATE steps SET pushed = ?, lost = lost AND ? WHERE session = ? AND step = ?",
+                (version, append, session_id, step),
+            )
+            return version
+
+    def set(self, session_id, step, text) -> int:
+        return self._push(session_id, step, text or "", append=False)
+
+    def append(self, session_id, step, text) -> int:
+        return self._push(session_id, step, text, append=True)
+
+    def apply_diff(self, session_id, step, diff) -> dict:
+        with self._transaction() as connection:
+            version, cid, pushed = self._entry(connection, session_id, step)
+            if diff["cid"] <= cid or 0 <= diff["base"] < pushed:
+                return None
+            if diff["base"] < 0:
+                base_text = ""
+            else:
+                base_text = self._get_text(connection, session_id, step, diff["base"])
+            if base_text is None:
+                return {"cid": diff["cid"], "resync": True}
+
+            text = base_text[: diff["start"]] + diff["text"] + base_text[diff["end"] :]
+            connection.execute(
+                "UPDATE steps SET cid = ?, lost = 0 WHERE session = ? AND step = ?",
+                (diff["cid"], session_id, step),
+            )
+            connection.execute(  # the browser moved past these versions
+                "DELETE FROM texts WHERE session = ? AND step = ? AND version < ?",
+                (session_id, step, diff["base"]),
+            )
+            version = self._add_version(connection, session_id, step, version, text)
+            return {"cid": diff["cid"], "version": version}
+
+
+# in memory, unless the server runs several processes (VOICEMYDOCS_TEXT_STORE=sqlite, see voicemydocs serve)
+if os.getenv("VOICEMYDOCS_TEXT_STORE") == "sqlite":
+    TEXT_STORE = SQLiteTextStore(TEXT_STORE_PATH)
+else:
+    TEXT_STORE = TextStore()
 
-        for future in futures:
-            audio_chunk = future.result()
-            audio += audio_chunk
 
-    return audio
+SEARCH_INDEX_LOCK = threading.Lock()
+SEARCH_INDEX_SYNCED = False
+
+
+def connect_search_index():
+    """Open the full-text index of the previous projects (SQLite FTS5), creating it if needed."""
+    connection = sqlite3.connect(SEARCH_INDEX_PATH, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS projects (id INTEGER PRIMARY KEY, name TEXT UNIQUE, mtime REAL);
+        CREATE VIRTUAL TABLE IF NOT EXISTS projects_fts USING fts5(
+            file, summary, transcript, tokenize = 'porter unicode61'
+        );
+        """
+    )
+    return connection
+
+
+def _insert_project(connection, name, draft_dict, mtime, parent=None):
+    transcript = draft_dict.get("transcript-text") or ""
+    if isinstance(transcript, list):
+        transcript = "\n".join(x["text"] for x in transcript)
+
+    row = connection.execute(
+        "SELECT id FROM projects WHERE name = ?", (name,)
+    ).fetchone()
+    if row is None:
+        project_id = connection.execute(
+            "INSERT INTO projects (name, mtime) VALUES (?, ?)", (name, mtime)
+        ).lastrowid
+    else:
+        project_id = row[0]
+        connection.execute(
+            "UPDATE projects SET mtime = ? WHERE id = ?", (mtime, project_id)
+        )
+        connection.execute("DELETE FROM projects_fts WHERE rowid = ?", (project_id,))
+
+    connection.execute(
+        "INSERT INTO projects_fts (rowid, file, summary, transcript) VALUES (?, ?, ?, ?)",
+        (
+            project_id,
+            draft_dict.get("file-text") or "",
+            draft_dict.get("summary-text") or "",
+            transcript,
+        ),
+    )
+    if parent is not None:  # the texts of the previous version are not indexed anymore
+        connection.execute(
+            "DELETE FROM projects_fts WHERE rowid IN (SELECT id FROM projects WHERE name = ?)",
+            (parent,),
+        )
+
+
+def index_project(name, draft_dict, mtime, parent=None):
+    """Add (or replace) a project in the search index. Only the latest version of a project is searchable,
+    so that its versions are not stored in the index as many whole documents.
+    """
+    connection = connect_search_index()
+    try:
+        with connection:
+            _insert_project(connection, name, draft_dict, mtime, parent)
+    finally:
+        connection.close()
+
+
+def sync_search_index():
+    """Bring the index up to date with the drafts in CACHE_DIRECTORY, e.g., after they were copied or deleted
+    by hand, only reading the new or modified ones. Return the number of projects (re)indexed.
+    """
+    drafts = {}
+    for entry in os.scandir(CACHE_DIRECTORY):
+        name, ext = os.path.splitext(entry.name)
+        if ext == ".json" and entry.is_file():
+            drafts[name] = entry.stat().st_mtime
+
+    connection = connect_search_index()
+    try:
+        indexed = {
+            name: (project_id, mtime)
+            for project_id, name, mtime in connection.execute("SELECT * FROM projects")
+        }
+        updated = [
+            name
+            for name, mtime in drafts.items()
+            if name not in indexed or indexed[name][1] < mtime
+        ]
+        with connection:  # a single transaction
+            for name in indexed.keys() - drafts.keys():
+                project_id = indexed[name][0]
+                connection.execute(
+                    "DELETE FROM projects_fts WHERE rowid = ?", (project_id,)
+                )
+                connection.execute("DELETE FROM projects WHERE id = ?", (project_id,))
+            for name in sorted(updated):  # the older versions first
+                try:
+                    draft_dict, _ = load_draft(name)
+                    with open(
+                        os.path.join(CACHE_DIRECTORY, f"{name}.json")
+                    ) as draft_file:
+                        parent = json.load(draft_file).get("parent")
+                except (OSError, ValueError, KeyError, RecursionError):
+                    continue
+                _insert_project(connection, name, draft_dict, drafts[name], parent)
+    finally:
+        connection.close()
+    return len(updated)
+
+
+def search_projects(query, limit=20):
+    """Search the previous projects, returning the best matches as dicts with name, snippet and score.
+    Every word of the query must be matched, also as a prefix, in the document, summary or transcript.
+    """
+    global SEARCH_INDEX_SYNCED
+    with SEARCH_INDEX_LOCK:  # once per process, then kept up to date by save_checkpoint
+        if not SEARCH_INDEX_SYNCED:
+            sync_search_index()
+            SEARCH_INDEX_SYNCED = True
+
+    words = re.findall(r"\w+", query or "")
+    if not words:
+        return []
+    match = " ".join(f'"{word}"*' for word in words)
+
+    connection = connect_search_index()
+    try:
+        rows = connection.execute(
+            """
+            SELECT name, snippet(projects_fts, -1, '[', ']', '...', 12), bm25(projects_fts, 1, 2, 1) AS score
+            FROM projects_fts JOIN projects ON projects.id = projects_fts.rowid
+            WHERE projects_fts MATCH ? ORDER BY score LIMIT ?
+            """,
+            (match, limit),
+        ).fetchall()
+    finally:
+        connection.close()
+    return [
+        dict(name=name, snippet=snippet, score=score) for name, snippet, score in rows
+    ]
 
 
 ################### PAGES ###############################################################################################
@@ -350,6 +1930,74 @@ page1 = html.Div(
     style={"display": "none"},
 )
 
+
+def preflight_panel(step):
+    """Options of the preflight of the generation of a step, and its estimates."""
+    return html.Div(
+        [
+            html.Div(
+                [
+                    dcc.Checklist(
+                        id=f"checklist-route-{step}",
+                        options=[
+                            {
+                                "label": "Use the fastest model within budget ($)",
+                                "value": "route",
+                            }
+                        ],
+                        value=[],
+                        inputStyle={"marginRight": "5px"},
+                    ),
+                    dcc.Input(
+                        id=f"input-budget-{step}",
+                        type="number",
+                        value=0.05,
+                        min=0,
+                        step=0.01,
+                        style={"marginLeft": "10px", "width": "80px"},
+                    ),
+                ],
+                style={"display": "flex", "alignItems": "center", "marginTop": "10px"},
+            ),
+            html.Small(id=f"preflight-info-{step}"),
+        ]
+    )
+
+
+def variants_panel(step):
+    """Fan-out of the generation of a step: run several prompts and models at once and compare the results."""
+    return html.Details(
+        [
+            html.Summary("Compare variants"),
+            dcc.Dropdown(
+                id=f"dropdown-variant-models-{step}",
+                options=MODEL_OPTIONS,
+                multi=True,
+                placeholder="Models (default: the one above)",
+                style={"marginTop": "5px"},
+            ),
+            dcc.Textarea(
+                id=f"textarea-variant-prompts-{step}",
+                placeholder="Alternative prompts, separated by a line with ---\n(the prompt above is always included)",
+                style={"width": "100%", "height": "100px", "marginTop": "5px"},
+            ),
+            dbc.Button(
+                "Run Variants",
+                color="secondary",
+                className="mr-1",
+                id=f"button-variants-{step}",
+            ),
+            dcc.Store(id=f"variants-group-{step}"),
+            dcc.Loading(
+                id=f"loading-variants-{step}",
+                type="circle",
+                children=html.Div(id=f"variants-{step}"),
+            ),
+        ],
+        style={"marginTop": "10px"},
+    )
+
+
 page2 = html.Div(
     [
         html.H1("Step 2: Summarize"),
@@ -363,6 +2011,25 @@ page2 = html.Div(
                             style={"width": "100%", "height": "600px"},
                             readOnly=False,
                         ),
+                        html.Div(
+                            [
+                                dcc.Checklist(
+                                    id="checklist-preprocess",
+                                    options=PREPROCESS_OPTIONS,
+                                    value=PREPROCESS_DEFAULT,
+                                    inputStyle={"marginRight": "5px"},
+                                ),
+                                dbc.Button(
+                                    "Clean Text",
+                                    color="secondary",
+                                    className="mr-1",
+                                    id="button-preprocess",
+                                    style={"marginLeft": "20px"},
+                                ),
+                            ],
+                            style={"display": "flex", "alignItems": "center"},
+                        ),
+                        html.Small(id="preprocess-info"),
                     ],
                     width=6,
                 ),
@@ -401,6 +2068,7 @@ page2 = html.Div(
                             id="button-generate-summary",
                             style={"marginTop": "10px"},
                         ),
+                        preflight_panel("summary"),
                         dcc.Loading(
                             id="loading-summary",
                             type="circle",
@@ -410,6 +2078,7 @@ page2 = html.Div(
                                 readOnly=True,
                             ),
                         ),
+                        variants_panel("summary"),
                     ]
                 ),
             ]
@@ -470,6 +2139,7 @@ page3 = html.Div(
                             id="button-generate-transcript",
                             style={"marginTop": "10px"},
                         ),
+                        preflight_panel("transcript"),
                         dcc.Loading(
                             id="loading-transcript",
                             type="circle",
@@ -479,6 +2149,7 @@ page3 = html.Div(
                                 readOnly=True,
                             ),
                         ),
+                        variants_panel("transcript"),
                     ]
                 ),
             ]
@@ -526,6 +2197,26 @@ page4 = html.Div(
                             ],
                             style={"display": "flex", "alignItems": "center"},
                         ),
+                        html.Div(
+                            [
+                                html.H5("Audio format"),
+                                dcc.Dropdown(
+                                    id="dropdown-tts-format",
+                                    options=[
+                                        {"value": key, "label": x["label"]}
+                                        for key, x in AUDIO_FORMATS.items()
+                                    ],
+                                    value=AUDIO_FORMAT_DEFAULT,
+                                    clearable=False,
+                                    style={"marginLeft": "10px", "width": "300px"},
+                                ),
+                            ],
+                            style={
+                                "display": "flex",
+                                "alignItems": "center",
+                                "marginTop": "10px",
+                            },
+                        ),
                         html.Div(
                             [
                                 html.H5("Voice for the speakers"),
@@ -598,6 +2289,19 @@ page4 = html.Div(
                                 style={"width": "100%", "height": "50px"},
                             ),
                         ),
+                        dcc.Checklist(
+                            id="checklist-speculative-tts",
+                            options=[
+                                {
+                                    "label": "Prepare the audio in background, while I review the transcript",
+                                    "value": "speculate",
+                                }
+                            ],
+                            value=[],
+                            inputStyle={"marginRight": "5px"},
+                        ),
+                        html.Small(id="speculation-info"),
+                        html.Br(),
                         html.Small(
                             "NOTE: once you generate the audio, all the previous steps will be saved. Each previous project is labelled with the timedate of creation, and can be loaded from the bottom left dropdown."
                         ),
@@ -668,6 +2372,13 @@ def serve_layout():
             ),
             html.Hr(),
             html.H5("Previous Projects"),
+            dcc.Input(
+                id="input-search-projects",
+                type="search",
+                placeholder="Search in past projects...",
+                debounce=True,
+                style={"width": "100%", "marginBottom": "5px"},
+            ),
             dcc.Dropdown(
                 id="dropdown-previous-projects",
                 placeholder="Load a past project...",
@@ -696,12 +2407,27 @@ def serve_layout():
     )
 
     return dbc.Container(
-        [dcc.Location(id="url"), dcc.Store(id="stored-audio"), sidebar, content],
+        [
+            dcc.Location(id="url"),
+            dcc.Store(id="session-id"),
+            *[dcc.Store(id=f"push-{step}") for step in TEXT_STEPS],
+            *[dcc.Store(id=f"diff-{step}") for step in TEXT_STEPS],
+            *[dcc.Store(id=f"ack-{step}") for step in TEXT_STEPS],
+            dcc.Store(id="resync-texts"),
+            dcc.Store(id="stored-upload"),
+            dcc.Store(id="extraction-cursor"),
+            dcc.Interval(id="interval-extraction", interval=500, disabled=True),
+            dcc.Store(id="stored-audio"),
+            dcc.Store(id="project-name"),  # the parent of the next checkpoint
+            dcc.Store(id="speculation-trigger"),
+            sidebar,
+            content,
+        ],
         fluid=True,
     )
 
 
-app.layout = serve_layout
+app.layout = serve_layout()  # built once, not at every page load
 
 
 ################### CALLBACKS ##########################################################################################
@@ -750,101 +2476,630 @@ def toggle_anthropic_password_visibility(n_clicks):
     return "password"
 
 
+#### TEXT SYNC CALLBACKS #######################################################
+# The text of each step lives in TEXT_STORE: the server sends it once to push-<step>, which is shown
+# in both textarea-<step> (if "view") and textarea-<step>-edit by a clientside callback.
+# The edits are sent back as diffs from diff-<step>, acknowledged in ack-<step>.
+
+
+@app.callback(
+    Output("session-id", "data"),
+    Input("url", "pathname"),
+    State("session-id", "data"),
+)
+def init_session(pathname, session_id):
+    """Create the session of the browser tab, on its first page."""
+    if session_id:
+        return dash.no_update
+    session_id = os.urandom(16).hex()
+    TEXT_STORE.register(session_id)
+    return session_id
+
+
+SYNC_STATE_JS = """
+    window.voicemydocsSync = window.voicemydocsSync || {};
+    window.voicemydocsSync[STEP] = window.voicemydocsSync[STEP] || {text: "", version: 0, cid: 0, sent: {}};
+    const sync = window.voicemydocsSync[STEP];
+"""
+
+PUSH_JS = (
+    """
+    function(push, view, edit) {
+        const no_update = window.dash_clientside.no_update;
+        if (!push) {
+            return [no_update, no_update];
+        }
+"""
+    + SYNC_STATE_JS
+    + """
+        const text = push.text || "";
+        let newView = no_update;
+        let newEdit = text;
+        if (push.append) {
+            newView = (view || "") + text;
+            newEdit = (edit || "") + text;
+        } else if (push.view) {
+            newView = text;
+        }
+        sync.text = newEdit;
+        sync.version = push.version;
+        sync.sent = {};
+        return [newView, newEdit];
+    }
+    """
+)
+
+DIFF_JS = (
+    """
+    function(value, ack, resync) {
+        value = value || "";
+"""
+    + SYNC_STATE_JS
+    + """
+        const triggered = window.dash_clientside.callback_context.triggered.map(x => x.prop_id);
+        let force = false;
+        if (triggered.includes("resync-texts.data") && resync && resync.steps.includes(STEP)) {
+            sync.text = "";  // the server lost the text: send it all again
+            sync.version = -1;
+            sync.sent = {};
+            force = true;
+        }
+        if (ack && ack.cid in sync.sent) {  // move the base of the diffs to the version acknowledged
+            if (ack.resync) {
+                sync.text = "";
+                sync.version = -1;
+                force = true;
+            } else if (ack.version > sync.version) {
+                sync.text = sync.sent[ack.cid];
+                sync.version = ack.version;
+            }
+            for (const cid in sync.sent) {
+                if (Number(cid) <= ack.cid) {
+                    delete sync.sent[cid];
+                }
+            }
+        }
+        const base = sync.text;
+        if (value === base && !force) {
+            return window.dash_clientside.no_update;
+        }
+        const maxStart = Math.min(value.length, base.length);
+        let start = 0;
+        while (start < maxStart && value[start] === base[start]) {
+            start++;
+        }
+        const maxEnd = maxStart - start;
+        let end = 0;
+        while (end < maxEnd && value[value.length - 1 - end] === base[base.length - 1 - end]) {
+            end++;
+        }
+        sync.cid += 1;
+        sync.sent[sync.cid] = value;
+        return {
+            cid: sync.cid,
+            base: sync.version,
+            start: start,
+            end: base.length - end,
+            text: value.slice(start, value.length - end),
+        };
+    }
+    """
+)
+
+
+def make_apply_diff(step):
+    def apply_diff(diff, session_id):
+        if diff is None or session_id is None:
+            return dash.no_update
+        ack = TEXT_STORE.apply_diff(session_id, step, diff)
+        return dash.no_update if ack is None else ack
+
+    apply_diff.__name__ = f"apply_diff_{step}"
+    return apply_diff
+
+
+for step in TEXT_STEPS:
+    app.clientside_callback(
+        PUSH_JS.replace("STEP", f"'{step}'"),
+        Output(f"textarea-{step}", "value"),
+        Output(f"textarea-{step}-edit", "value"),
+        Input(f"push-{step}", "data"),
+        State(f"textarea-{step}", "value"),
+        State(f"textarea-{step}-edit", "value"),
+        prevent_initial_call=True,
+    )
+    app.clientside_callback(
+        DIFF_JS.replace("STEP", f"'{step}'"),
+        Output(f"diff-{step}", "data"),
+        Input(f"textarea-{step}-edit", "value"),
+        Input(f"ack-{step}", "data"),
+        Input("resync-texts", "data"),
+        prevent_initial_call=True,
+    )
+    app.callback(
+        Output(f"ack-{step}", "data"),
+        Input(f"diff-{step}", "data"),
+        State("session-id", "data"),
+        prevent_initial_call=True,
+    )(make_apply_diff(step))
+
+
+def push_text(session_id, step, text, view=False):
+    """Set the text of a step and return the data for push-<step>, showing it in the textareas."""
+    version = TEXT_STORE.set(session_id, step, text)
+    return {"text": text, "version": version, "view": view}
+
+
+TEXTS_LOST_MESSAGE = "The server lost the texts (e.g., it restarted): they are being sent again, please retry..."
+
+
+def resync_texts(session_id, steps):
+    """Return the data for resync-texts, asking the browser to send again the texts of the steps
+    that the server lost, or None if there are none.
+    """
+    lost = [x for x in steps if TEXT_STORE.is_lost(session_id, x)]
+    return {"steps": lost, "nonce": os.urandom(4).hex()} if lost else None
+
+
+#### STEP CALLBACKS ##############################################################
+
+
 @app.callback(
     Output("iframe-file", "src"),
-    Output("textarea-file", "value"),
-    Output("textarea-file-edit", "value"),
+    Output("stored-upload", "data"),
+    Output("upload-pdf", "contents"),
+    Output("push-file", "data", allow_duplicate=True),
+    Output("extraction-cursor", "data"),
+    Output("interval-extraction", "disabled"),
+    Output("textarea-file-edit", "readOnly"),
+    Output("project-name", "data", allow_duplicate=True),
     Input("upload-pdf", "contents"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
 )
-def display_pdf(contents):
+def display_pdf(contents, session_id):
+    """Store the uploaded PDF server-side and only pass its handle around:
+    the iframe reads the file from the /uploads route, and the upload contents are cleared.
+    The text is extracted in background and progressively shown by poll_extraction.
+    A new document starts a new project, i.e., the next checkpoint has no parent.
+    """
     if contents is not None:
-        content_type, content_string = contents.split(",")
-        decoded = base64.b64decode(content_string)
-        pdf_text = extract_text_from_pdf(decoded)
+        upload_id = store_upload(contents)
+        start_extraction(upload_id)
+
+        return (
+            f"/uploads/{upload_id}.pdf",
+            upload_id,
+            None,
+            push_text(session_id, "file", "", view=True),
+            0,
+            False,
+            True,  # read-only while the pages are appended
+            None,
+        )
+    return [dash.no_update] * 8
+
 
-        return contents, pdf_text, pdf_text
-    return "/assets/pdf-placeholder.svg", None, None
+@app.callback(
+    Output("push-file", "data", allow_duplicate=True),
+    Output("extraction-cursor", "data", allow_duplicate=True),
+    Output("interval-extraction", "disabled", allow_duplicate=True),
+    Output("textarea-file-edit", "readOnly", allow_duplicate=True),
+    Input("interval-extraction", "n_intervals"),
+    State("stored-upload", "data"),
+    State("extraction-cursor", "data"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+def poll_extraction(n_intervals, upload_id, offset, session_id):
+    """Send the pages extracted since the previous poll, and stop polling once the extraction is complete."""
+    if upload_id is None:
+        return dash.no_update, dash.no_update, True, False
+
+    lost = TEXT_STORE.is_lost(session_id, "file")
+    if lost:  # send again all the pages extracted so far
+        offset = 0
+    text, new_offset, done = read_extracted_pages(upload_id, offset or 0)
+    push = dash.no_update
+    if lost:
+        push = push_text(session_id, "file", text, view=True)
+    elif text:
+        version = TEXT_STORE.append(session_id, "file", text)
+        push = {"text": text, "version": version, "append": True}
+
+    return push, new_offset, done, not done
+
+
+@app.callback(
+    Output("push-file", "data", allow_duplicate=True),
+    Output("preprocess-info", "children"),
+    Output("resync-texts", "data", allow_duplicate=True),
+    Input("button-preprocess", "n_clicks"),
+    State("checklist-preprocess", "value"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+def clean_text(n_clicks, steps, session_id):
+    resync = resync_texts(session_id, ["file"])
+    if resync:
+        return dash.no_update, TEXTS_LOST_MESSAGE, resync
+
+    input_text = TEXT_STORE.get(session_id, "file")
+    if not input_text:
+        return dash.no_update, "Please upload a document first...", dash.no_update
+
+    cleaned_text, stats = preprocess_text(input_text, steps)
+    percent_saved = 100 * stats["chars_saved"] / max(1, stats["chars_before"])
+
+    return (
+        push_text(session_id, "file", cleaned_text),
+        f"Removed {stats['chars_saved']}c ({percent_saved:.0f}%), ~{stats['tokens_saved']} tokens saved",
+        dash.no_update,
+    )
+
+
+STEP_INPUTS = {"summary": "file", "transcript": "summary"}
+
+
+def make_update_preflight(step):
+    def update_preflight(pathname, ack, prompt, model, route, budget, session_id):
+        input_text = TEXT_STORE.get(session_id, STEP_INPUTS[step]) if session_id else ""
+        if not input_text:
+            return ""
+        return describe_plan(preflight(prompt, input_text, model, budget, bool(route)))
+
+    update_preflight.__name__ = f"update_preflight_{step}"
+    return update_preflight
+
+
+for step in STEP_INPUTS:
+    app.callback(
+        Output(f"preflight-info-{step}", "children"),
+        Input("url", "pathname"),
+        Input(f"ack-{STEP_INPUTS[step]}", "data"),
+        Input(f"textarea-prompt-{step}", "value"),
+        Input(f"dropdown-model-{step}", "value"),
+        Input(f"checklist-route-{step}", "value"),
+        Input(f"input-budget-{step}", "value"),
+        State("session-id", "data"),
+        prevent_initial_call=True,
+    )(make_update_preflight(step))
 
 
 @app.callback(
-    Output("textarea-summary", "value"),
-    Output("textarea-summary-edit", "value"),
+    Output("push-summary", "data", allow_duplicate=True),
+    Output("preflight-info-summary", "children", allow_duplicate=True),
+    Output("resync-texts", "data", allow_duplicate=True),
+    Output("dropdown-model-summary", "value", allow_duplicate=True),
     Input("button-generate-summary", "n_clicks"),
-    State("textarea-file-edit", "value"),
     State("textarea-prompt-summary", "value"),
     State("dropdown-model-summary", "value"),
+    State("checklist-route-summary", "value"),
+    State("input-budget-summary", "value"),
     State("input-openai-api-key", "value"),
+    State("session-id", "data"),
+    State("stored-upload", "data"),
     prevent_initial_call=True,
 )
-def generate_summary(n_clicks, input_text, prompt, model, openai_key):
-    if input_text is None:
-        return "Please upload a document first..."
-
-    summary_text = call_llm_api(
-        system_content=prompt,
-        user_content=input_text,
-        model=model,
-        api_keys={"openai": openai_key},
-    )
-
-    return summary_text, summary_text
+def generate_summary(
+    n_clicks, prompt, model, route, budget, openai_key, session_id, upload_id
+):
+    if upload_id is not None and not is_extraction_done(upload_id):
+        # the document is still being extracted: its chunks are summarized as soon as they are complete
+        max_chars = get_chunk_chars(model, estimate_tokens(prompt or ""))
+        chunks = (
+            part
+            for chunk in iter_text_chunks(iter_extraction_pages(upload_id), max_chars)
+            for part in split_text_chunks(chunk, max_chars)
+        )
+        summary_text = call_llm_chunks(chunks, prompt, model, {"openai": openai_key})
+        info = f"Summarized with {model} while the document was being extracted"
+        push = push_text(session_id, "summary", summary_text, view=True)
+        return push, info, dash.no_update, dash.no_update
+
+    resync = resync_texts(session_id, ["file"])
+    if resync:
+        return dash.no_update, TEXTS_LOST_MESSAGE, resync, dash.no_update
+
+    input_text = TEXT_STORE.get(session_id, "file")
+    if not input_text:
+        message = "Please upload a document first..."
+        push = push_text(session_id, "summary", message, view=True)
+        return push, dash.no_update, dash.no_update, dash.no_update
+
+    # a long document is summarized in chunks, merged by a final request
+    plan = preflight(prompt, input_text, model, budget, bool(route))
+    summary_text = call_llm_planned(plan, prompt, {"openai": openai_key})
+
+    push = push_text(session_id, "summary", summary_text, view=True)
+    # the model routed to is shown, and then saved in the checkpoint
+    return push, describe_plan(plan), dash.no_update, plan["model"]
 
 
 @app.callback(
-    Output("textarea-transcript", "value"),
-    Output("textarea-transcript-edit", "value"),
+    Output("push-transcript", "data", allow_duplicate=True),
+    Output("preflight-info-transcript", "children", allow_duplicate=True),
+    Output("speculation-trigger", "data"),
+    Output("resync-texts", "data", allow_duplicate=True),
+    Output("dropdown-model-transcript", "value", allow_duplicate=True),
     Input("button-generate-transcript", "n_clicks"),
-    State("textarea-summary-edit", "value"),
     State("textarea-prompt-transcript", "value"),
     State("dropdown-model-transcript", "value"),
+    State("checklist-route-transcript", "value"),
+    State("input-budget-transcript", "value"),
     State("input-openai-api-key", "value"),
+    State("session-id", "data"),
     prevent_initial_call=True,
 )
-def generate_transcript(n_clicks, input_text, prompt, model, openai_key):
-    if input_text is None:
-        return "Please upload a document first..."
+def generate_transcript(n_clicks, prompt, model, route, budget, openai_key, session_id):
+    no_update = dash.no_update
+    resync = resync_texts(session_id, ["summary"])
+    if resync:
+        return no_update, TEXTS_LOST_MESSAGE, no_update, resync, no_update
 
-    transcript_text = call_llm_api(
-        system_content=prompt,
-        user_content=input_text,
-        model=model,
-        api_keys={"openai": openai_key},
-    )
+    input_text = TEXT_STORE.get(session_id, "summary")
+    if not input_text:
+        message = "Please generate a summary first..."
+        push = push_text(session_id, "transcript", message, view=True)
+        return push, no_update, no_update, no_update, no_update
+
+    # a transcript is a single dialogue: rejected, instead of chunked, if it doesn't fit
+    plan = preflight(prompt, input_text, model, budget, bool(route), chunk=False)
+    if "error" in plan:
+        return no_update, plan["error"], no_update, no_update, no_update
+
+    transcript_text = call_llm_planned(plan, prompt, {"openai": openai_key})
+
+    push = push_text(session_id, "transcript", transcript_text, view=True)
+    # the model routed to is shown, and then saved in the checkpoint
+    return push, describe_plan(plan), push["version"], no_update, plan["model"]
 
-    return transcript_text, transcript_text
+
+@app.callback(
+    Output("speculation-info", "children"),
+    Input("speculation-trigger", "data"),
+    Input("ack-transcript", "data"),
+    Input("dropdown-speaker1", "value"),
+    Input("dropdown-speaker2", "value"),
+    Input("dropdown-speaker3", "value"),
+    Input("dropdown-model-tts", "value"),
+    Input("dropdown-tts-format", "value"),
+    Input("checklist-speculative-tts", "value"),
+    State("input-openai-api-key", "value"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+def speculate_audio(
+    trigger,
+    ack,
+    speaker1,
+    speaker2,
+    speaker3,
+    tts_model,
+    response_format,
+    speculate,
+    api_key,
+    session_id,
+):
+    """When the transcript is generated or edited, or the voices or the format change, (re)start the speculative
+    synthesis of the audio, if enabled: only the new or changed turns are synthesized.
+    """
+    if session_id is None:
+        return dash.no_update
+
+    transcript = TEXT_STORE.get(session_id, "transcript")
+    if not speculate or not api_key or not transcript:
+        cancel_speculation(session_id)
+        return ""
+
+    speakers_voice = [speaker1, speaker2, speaker3]
+    try:
+        speculate_tts(
+            session_id, transcript, speakers_voice, tts_model, api_key, response_format
+        )
+    except ValueError as error:  # e.g., too many speakers
+        return str(error)
+    return "Preparing the audio in background..."
+
+
+#### VARIANTS CALLBACKS ########################################################
+
+
+def render_variants(step, results):
+    cards = []
+    for index, result in enumerate(results):
+        header = f"{result['model']} · {result['seconds']:.1f}s · {result['chars']}c · ${result['cost']:.4f}"
+        cards.append(
+            dbc.Col(
+                [
+                    html.Small(html.B(header)),
+                    html.Br(),
+                    html.Small(
+                        result["prompt"][:100]
+                        + ("..." if len(result["prompt"]) > 100 else "")
+                    ),
+                    dcc.Textarea(
+                        value=result["error"] or result["text"],
+                        style={"width": "100%", "height": "200px"},
+                        readOnly=True,
+                    ),
+                    dbc.Button(
+                        "Use this",
+                        color="primary",
+                        size="sm",
+                        id={"type": "button-use-variant", "step": step, "index": index},
+                        disabled=result["error"] is not None,
+                    ),
+                ],
+                width=max(4, 12 // max(1, len(results))),
+                style={"marginTop": "10px"},
+            )
+        )
+    return dbc.Row(cards)
+
+
+def make_run_variants(step):
+    def generate_variants(
+        n_clicks, models, alternative_prompts, prompt, model, openai_key, session_id
+    ):
+        resync = resync_texts(session_id, [STEP_INPUTS[step]])
+        if resync:
+            return dash.no_update, TEXTS_LOST_MESSAGE, resync
+
+        input_text = TEXT_STORE.get(session_id, STEP_INPUTS[step])
+        if not input_text:
+            message = "Please complete the previous step first..."
+            return dash.no_update, message, dash.no_update
+
+        prompts = [prompt] + [
+            x.strip() for x in re.split(r"^---$", alternative_prompts or "", flags=re.M)
+        ]
+        prompts = list(
+            dict.fromkeys(x for x in prompts if x)
+        )  # in order, without duplicates
+        results = run_variants(
+            prompts, models or [model], input_text, {"openai": openai_key}
+        )
+
+        group = save_variants(step, input_text, results)
+        return group, render_variants(step, results), dash.no_update
+
+    generate_variants.__name__ = f"generate_variants_{step}"
+    return generate_variants
+
+
+def make_use_variant(step):
+    def use_variant(n_clicks, group, session_id):
+        if not any(n_clicks) or group is None:
+            return dash.no_update, dash.no_update, dash.no_update
+
+        variant = load_variant(group, ctx.triggered_id["index"])
+        return (
+            push_text(session_id, step, variant["text"], view=True),
+            variant["prompt"],
+            variant["model"],
+        )
+
+    use_variant.__name__ = f"use_variant_{step}"
+    return use_variant
+
+
+for step in STEP_INPUTS:
+    app.callback(
+        Output(f"variants-group-{step}", "data"),
+        Output(f"variants-{step}", "children"),
+        Output("resync-texts", "data", allow_duplicate=True),
+        Input(f"button-variants-{step}", "n_clicks"),
+        State(f"dropdown-variant-models-{step}", "value"),
+        State(f"textarea-variant-prompts-{step}", "value"),
+        State(f"textarea-prompt-{step}", "value"),
+        State(f"dropdown-model-{step}", "value"),
+        State("input-openai-api-key", "value"),
+        State("session-id", "data"),
+        prevent_initial_call=True,
+    )(make_run_variants(step))
+    app.callback(
+        Output(f"push-{step}", "data", allow_duplicate=True),
+        Output(f"textarea-prompt-{step}", "value", allow_duplicate=True),
+        Output(f"dropdown-model-{step}", "value", allow_duplicate=True),
+        Input({"type": "button-use-variant", "step": step, "index": ALL}, "n_clicks"),
+        State(f"variants-group-{step}", "data"),
+        State("session-id", "data"),
+        prevent_initial_call=True,
+    )(make_use_variant(step))
 
 
 @app.callback(
     Output("stored-audio", "data"),
     Output("audio-player", "src"),
+    Output("speculation-info", "children", allow_duplicate=True),
+    Output("resync-texts", "data", allow_duplicate=True),
     Input("button-tts", "n_clicks"),
-    State("textarea-transcript-edit", "value"),
     State("dropdown-speaker1", "value"),
     State("dropdown-speaker2", "value"),
     State("dropdown-speaker3", "value"),
     State("dropdown-model-tts", "value"),
+    State("dropdown-tts-format", "value"),
     State("input-openai-api-key", "value"),
+    State("session-id", "data"),
     prevent_initial_call=True,
 )
 def text2audio_store_play(
-    n_clicks, transcript, speaker1, speaker2, speaker3, tts_model, api_key
+    n_clicks,
+    speaker1,
+    speaker2,
+    speaker3,
+    tts_model,
+    response_format,
+    api_key,
+    session_id,
 ):
-    if api_key is None:
-        return "Please enter your OpenAI API Key..."
-    if transcript is None:
-        return "Please generate a transcript first..."
+    resync = resync_texts(
+        session_id, TEXT_STEPS
+    )  # all of them are saved with the audio
+    if resync:
+        return dash.no_update, dash.no_update, TEXTS_LOST_MESSAGE, resync
+
+    transcript = TEXT_STORE.get(session_id, "transcript")
+    if api_key is None or not transcript:
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update
 
     speakers_voice = [speaker1, speaker2, speaker3]
-    audio_data = compile_dialogue(transcript, speakers_voice, tts_model, api_key)
+    cancel_speculation(session_id)  # the job synthesizes what is left
+    try:
+        job_id = start_tts_job(
+            transcript, speakers_voice, tts_model, api_key, response_format
+        )
+    except ValueError as error:  # e.g., too many speakers
+        return dash.no_update, dash.no_update, str(error), dash.no_update
+    # the checkpoint saves the texts of the click, not the ones edited during the playback
+    texts = {step: TEXT_STORE.get(session_id, step) for step in TEXT_STEPS}
+    write_atomic(get_job_texts_path(session_id, job_id), json.dumps(texts))
+
+    # the player starts with the first turn, while the next ones are synthesized
+    return job_id, f"/audio/stream/{job_id}", dash.no_update, dash.no_update
+
+
+@server.route("/metrics")
+def metrics():
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+
+@server.route("/audio/stream/<job_id>")
+def stream_audio(job_id):
+    if not os.path.exists(get_job_path(job_id)):
+        abort(404)
+    response_format = get_job_format(job_id)
+    return Response(
+        iter_stream_audio(iter_job_audio(job_id), response_format),
+        mimetype=AUDIO_FORMATS[response_format]["mimetype"],
+    )
 
-    audio_data_base64 = base64.b64encode(audio_data).decode("utf-8")
 
-    return audio_data_base64, f"data:audio/mp3;base64,{audio_data_base64}"
+@server.route("/uploads/<upload_id>.pdf")
+def download_upload(upload_id):
+    return send_from_directory(
+        UPLOAD_DIRECTORY, f"{upload_id}.pdf", mimetype="application/pdf"
+    )
 
 
 @server.route("/.voicemydocs_cache/<path:filename>")
 def download_file(filename):
-    return send_from_directory(CACHE_DIRECTORY, filename)
+    """Serve the drafts and the audio of the projects, and nothing else of CACHE_DIRECTORY
+    (e.g., neither the texts of the sessions, nor the uploads, nor the search index).
+    """
+    name, ext = os.path.splitext(filename)
+    ext = ext.lstrip(".")
+    if "/" in filename or ext not in {"json", *MIMETYPES}:
+        abort(404)
+    if not os.path.exists(os.path.join(CACHE_DIRECTORY, filename)) and ext in MIMETYPES:
+        # the audio of a checkpoint that references its segments
+        try:
+            audio_data = load_project_audio(name)
+        except (OSError, ValueError, KeyError):
+            abort(404)
+        return send_file(io.BytesIO(audio_data), mimetype=MIMETYPES[ext])
+    return send_from_directory(CACHE_DIRECTORY, filename, mimetype=MIMETYPES.get(ext))
 
 
 def get_log_dict(*args):
@@ -864,6 +3119,7 @@ def get_log_dict(*args):
         "counter-summary",
         "counter-transcript",
         "counter-audio",
+        "tts-format",
     ]
 
     args = list(args)
@@ -875,14 +3131,14 @@ def get_log_dict(*args):
 
 @app.callback(
     Output("previous-projects-info", "children", allow_duplicate=True),  # dummy
+    Output("project-name", "data", allow_duplicate=True),
     Input("stored-audio", "data"),
-    State("textarea-file-edit", "value"),
+    State("session-id", "data"),
+    State("project-name", "data"),
     State("textarea-prompt-summary", "value"),
     State("dropdown-model-summary", "value"),
-    State("textarea-summary-edit", "value"),
     State("textarea-prompt-transcript", "value"),
     State("dropdown-model-transcript", "value"),
-    State("textarea-transcript-edit", "value"),
     State("dropdown-model-tts", "value"),
     State("dropdown-speaker1", "value"),
     State("dropdown-speaker2", "value"),
@@ -893,30 +3149,209 @@ def get_log_dict(*args):
     State("counter-audio", "children"),
     prevent_initial_call=True,
 )
-def write_checkpoint(audio_data_base64, *args):
-    """When the audio is generated, store the mp3 file and the draft (with all the text, prompt and settings used)
-    as CACHE_DIRECTORY/filename.mp3 and .json, respectively.
+def write_checkpoint(
+    job_id,
+    session_id,
+    parent,
+    summary_prompt,
+    summary_model,
+    transcript_prompt,
+    transcript_model,
+    *args,
+):
+    """When the audio is requested, wait for its synthesis and store the draft (with all the text, prompt and settings used)
+    as CACHE_DIRECTORY/filename.json, as a new version of the project loaded or saved last in the session.
     These files will be subsequently available as "Previous Projects" to be reloaded and edited.
+    The texts are the ones of TEXT_STORE when the audio was requested, instead of being sent back by the browser.
     """
 
-    if audio_data_base64 is None:
-        return dash.no_update
+    if job_id is None:
+        return dash.no_update, dash.no_update
+
+    texts_path = get_job_texts_path(session_id, job_id)
+    try:
+        with open(texts_path) as texts_file:
+            texts = json.load(texts_file)
+        os.remove(texts_path)
+    except (OSError, ValueError):  # e.g., a job requested before an upgrade
+        texts = {step: TEXT_STORE.get(session_id, step) for step in TEXT_STEPS}
+
+    response_format = get_job_format(job_id)
+    segment_keys = wait_tts_job(job_id)
+    draft_dict = get_log_dict(
+        texts["file"],
+        summary_prompt,
+        summary_model,
+        texts["summary"],
+        transcript_prompt,
+        transcript_model,
+        texts["transcript"],
+        *args,
+    )
+    draft_dict["tts-format"] = response_format
+    draft_dict["audio-segments"] = segment_keys
+    filename = save_checkpoint(None, draft_dict, response_format, parent=parent)
+
+    return "Adding a new project...", filename
 
-    audio_data = base64.b64decode(audio_data_base64)
 
-    filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-    audio_file_path = os.path.join(CACHE_DIRECTORY, f"{filename}.mp3")
+CHECKPOINT_MAX_DEPTH = (
+    32  # a full draft every that many versions, to bound the reconstruction
+)
+
 
-    with open(audio_file_path, "wb") as audio_file:
-        audio_file.write(audio_data)
+def _draft_units(value):
+    if isinstance(value, str):
+        return value.splitlines(keepends=True)
+    return [json.dumps(x) for x in value]
 
-    draft_dict = get_log_dict(*args)
-    draft_file_path = os.path.join(CACHE_DIRECTORY, f"{filename}.json")
 
-    with open(draft_file_path, "w") as draft_file:
-        json.dump(draft_dict, draft_file, indent=4)
+def diff_draft_value(parent_value, value):
+    """Encode a text (by lines) or a list (by items) as the ranges it copies from the value of the parent version
+    and the units it inserts, e.g., {"diff": [[0, 12], ["A new line\\n"], [14, 30]]}.
+    Return the value itself if it is not a text or a list, or if its diff is not smaller.
+    """
+    if not isinstance(value, (str, list)) or type(value) is not type(parent_value):
+        return value
 
-    return "Adding a new project..."
+    parent_units, units = _draft_units(parent_value), _draft_units(value)
+    if units == parent_units:
+        ops = [[0, len(units)]] if units else []
+    else:
+        ops = []
+        matcher = difflib.SequenceMatcher(None, parent_units, units)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                ops.append([i1, i2])
+            elif j2 > j1:  # replace or insert
+                ops.append(units[j1:j2])
+
+    diff = {"diff": ops}
+    return diff if len(json.dumps(diff)) < len(json.dumps(value)) else value
+
+
+def patch_draft_value(parent_value, diff):
+    """Inverse of diff_draft_value."""
+    parent_units = _draft_units(parent_value)
+    units = []
+    for op in diff["diff"]:
+        units.extend(parent_units[op[0] : op[1]] if isinstance(op[0], int) else op)
+    if isinstance(parent_value, str):
+        return "".join(units)
+    return [json.loads(x) for x in units]
+
+
+@functools.lru_cache(maxsize=256)
+def _load_draft(name, mtime):
+    with open(os.path.join(CACHE_DIRECTORY, f"{name}.json")) as draft_file:
+        stored_dict = json.load(draft_file)
+
+    parent = stored_dict.pop("parent", None)
+    if parent is None:
+        return stored_dict, 0
+
+    parent_dict, depth = load_draft(parent)
+    draft_dict = {
+        key: patch_draft_value(parent_dict[key], value)
+        if isinstance(value, dict) and "diff" in value
+        else value
+        for key, value in stored_dict.items()
+    }
+    return draft_dict, depth + 1
+
+
+def load_draft(name):
+    """Return the draft of a project, reconstructed from the diffs of its versions, and the number of its ancestors.
+    The drafts are immutable once written, so they are cached by name (and mtime, if edited by hand).
+    """
+    mtime = os.path.getmtime(os.path.join(CACHE_DIRECTORY, f"{name}.json"))
+    draft_dict, depth = _load_draft(name, mtime)
+    return dict(draft_dict), depth
+
+
+def encode_draft(draft_dict, parent=None):
+    """Return the draft to be written for a new version of the parent project: the values that changed little
+    are diffs (see diff_draft_value), including the list of the audio segments, which are shared by reference.
+    """
+    if parent is None:
+        return draft_dict
+    try:
+        parent_dict, depth = load_draft(parent)
+    except (OSError, ValueError, KeyError, RecursionError):
+        return draft_dict  # e.g., the parent was deleted
+    if depth + 1 >= CHECKPOINT_MAX_DEPTH:
+        return draft_dict
+
+    stored_dict = {
+        key: diff_draft_value(parent_dict[key], value) if key in parent_dict else value
+        for key, value in draft_dict.items()
+    }
+    stored_dict["parent"] = parent
+    return stored_dict
+
+
+def load_project_audio(name):
+    """Return the audio of a project, from its file, or assembled from the segments its draft references."""
+    audio_file_path = get_project_audio_path(name)
+    if audio_file_path is not None:
+        with open(audio_file_path, "rb") as audio_file:
+            return audio_file.read()
+
+    draft_dict, _ = load_draft(name)
+    response_format = draft_dict.get("tts-format", AUDIO_FORMAT_DEFAULT)
+    segments = []
+    for segment_key in draft_dict["audio-segments"]:
+        with open(get_segment_path(segment_key, response_format), "rb") as segment_file:
+            segments.append(segment_file.read())
+    return concat_audio(segments, response_format)
+
+
+@instrumented("checkpoint_write")
+def save_checkpoint(
+    audio_data, draft_dict, response_format=AUDIO_FORMAT_DEFAULT, parent=None
+):
+    """Write the audio and the draft of a project in CACHE_DIRECTORY, and return the name of the project.
+    The audio is not written if it is None, and the draft references its segments ("audio-segments") instead.
+    With a parent project, the draft is written as a new version of it (see encode_draft).
+    The files are written aside and then linked into place, so that a project is never listed half-written.
+    """
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    tmp_path = os.path.join(
+        CACHE_DIRECTORY, f"{timestamp}.{os.getpid()}.{threading.get_ident()}"
+    )
+    with open(f"{tmp_path}.json.tmp", "w") as draft_file:
+        json.dump(encode_draft(draft_dict, parent), draft_file, indent=4)
+    if audio_data is not None:
+        with open(f"{tmp_path}.audio.tmp", "wb") as audio_file:
+            audio_file.write(audio_data)
+
+    filename, counter = timestamp, 1
+    while True:
+        draft_file_path = os.path.join(CACHE_DIRECTORY, f"{filename}.json")
+        try:
+            os.link(
+                f"{tmp_path}.json.tmp", draft_file_path
+            )  # fails if the name is taken
+            break
+        except FileExistsError:
+            counter += 1  # e.g., several projects of a batch in the same second
+            filename = f"{timestamp}_{counter}"
+    os.remove(f"{tmp_path}.json.tmp")
+
+    if audio_data is not None:
+        ext = AUDIO_FORMATS[response_format]["ext"]
+        os.replace(
+            f"{tmp_path}.audio.tmp", os.path.join(CACHE_DIRECTORY, f"{filename}.{ext}")
+        )
+
+    METRICS.inc(
+        "voicemydocs_bytes_total",
+        len(audio_data or b"") + os.path.getsize(draft_file_path),
+        stage="checkpoint_write",
+        direction="out",
+    )
+    index_project(filename, draft_dict, os.path.getmtime(draft_file_path), parent)
+    return filename
 
 
 @app.callback(
@@ -926,16 +3361,31 @@ def write_checkpoint(audio_data_base64, *args):
 )
 def load_previous_projects(dummy):
     """Load the list of previous projects from the CACHE_DIRECTORY and return the list of filenames."""
-    files = os.listdir(CACHE_DIRECTORY)
     filenames_valid = [
-        f.split(".")[0]
-        for f in files
-        if f.endswith(".mp3") and f"{f[:-4]}.json" in files
+        entry.name[: -len(".json")]
+        for entry in os.scandir(CACHE_DIRECTORY)
+        if entry.name.endswith(".json") and entry.is_file()
     ]
     filenames_valid.sort(reverse=True)  # sort from most recent to oldest
     return filenames_valid, f"You have {len(filenames_valid)} past projects"
 
 
+@app.callback(
+    Output("dropdown-previous-projects", "options", allow_duplicate=True),
+    Input("input-search-projects", "value"),
+    prevent_initial_call=True,
+)
+def search_previous_projects(query):
+    """Restrict the list of previous projects to the ones matching the query, best first, with a snippet."""
+    if not (query or "").strip():
+        return load_previous_projects(None)[0]
+
+    return [
+        dict(label=f"{match['name']}: {match['snippet']}", value=match["name"])
+        for match in search_projects(query)
+    ]
+
+
 def transcript_dict2text(transcript_dict):
     """Converts a list of dictionaries into a dialogue string, e.g.,
     ---
@@ -957,120 +3407,451 @@ def transcript_dict2text(transcript_dict):
 
 
 @app.callback(
-    Output("textarea-file-edit", "value", allow_duplicate=True),
+    Output("push-file", "data", allow_duplicate=True),
     Output("textarea-prompt-summary", "value", allow_duplicate=True),
     Output("dropdown-model-summary", "value", allow_duplicate=True),
-    Output("textarea-summary-edit", "value", allow_duplicate=True),
+    Output("push-summary", "data", allow_duplicate=True),
     Output("textarea-prompt-transcript", "value", allow_duplicate=True),
     Output("dropdown-model-transcript", "value", allow_duplicate=True),
-    Output("textarea-transcript-edit", "value", allow_duplicate=True),
+    Output("push-transcript", "data", allow_duplicate=True),
     Output("dropdown-model-tts", "value", allow_duplicate=True),
     Output("dropdown-speaker1", "value", allow_duplicate=True),
     Output("dropdown-speaker2", "value", allow_duplicate=True),
     Output("dropdown-speaker3", "value", allow_duplicate=True),
     Output("audio-player", "src", allow_duplicate=True),
+    Output("dropdown-tts-format", "value"),
+    Output("project-name", "data"),
     Input("dropdown-previous-projects", "value"),
+    State("session-id", "data"),
     prevent_initial_call=True,
 )
-def load_previous_project(filename):
+def load_previous_project(filename, session_id):
     """Load the data from the selected project and return the values to the corresponding components.
     Assuming that the order of the output is the same as the order of the json keys,
     excluding the counters that are in the last positions.
+    The texts are set in TEXT_STORE, and pushed to the browser.
     """
     if filename is None:
         return [  # default values
-            None,
+            push_text(session_id, "file", ""),
             DEFAULT_SUMMARY_PROMPT,
             MODEL_DEFAULT,
-            None,
+            push_text(session_id, "summary", ""),
             DEFAULT_TRANSCRIPT_PROMPT,
             MODEL_DEFAULT,
-            None,
+            push_text(session_id, "transcript", ""),
             TTS_DEFAULT["model"],
             "nova",
             "echo",
             "onyx",
             DEFAULT_AUDIO_SRC,
+            AUDIO_FORMAT_DEFAULT,
+            None,
         ]
 
-    draft_file_path = os.path.join(CACHE_DIRECTORY, f"{filename}.json")
-    with open(draft_file_path, "r") as draft_file:
-        draft_dict = json.load(draft_file)
+    try:
+        draft_dict, _ = load_draft(filename)
+    except (OSError, ValueError, KeyError, RecursionError):
+        return [dash.no_update] * 14  # e.g., deleted or corrupted meanwhile
 
     draft_dict["transcript-text"] = transcript_dict2text(draft_dict["transcript-text"])
+    for step in TEXT_STEPS:
+        draft_dict[f"{step}-text"] = push_text(
+            session_id, step, draft_dict[f"{step}-text"]
+        )
+
+    # the audio is played from its file (or its segments), instead of being sent within the response
+    response_format = draft_dict.get("tts-format", AUDIO_FORMAT_DEFAULT)
+    audio_file_path = get_project_audio_path(filename)
+    if audio_file_path is not None:
+        audio_file_name = os.path.basename(audio_file_path)
+    else:
+        audio_file_name = f"{filename}.{AUDIO_FORMATS[response_format]['ext']}"
+    audio_src = f"/.voicemydocs_cache/{audio_file_name}"
 
-    # load mp3 file
-    audio_file_path = os.path.join(CACHE_DIRECTORY, f"{filename}.mp3")
-    with open(audio_file_path, "rb") as audio_file:
-        audio_data = audio_file.read()
-        audio_data_base64 = base64.b64encode(audio_data).decode("utf-8")
-        audio_src = f"data:audio/mp3;base64,{audio_data_base64}"
-
-    return list(draft_dict.values())[:11] + [audio_src]
+    return list(draft_dict.values())[:11] + [audio_src, response_format, filename]
 
 
 #### COUNTERS CALLBACKS #########################################################
+# Computed in the browser, so that the texts are not sent to the server at every edit.
 
-
-@app.callback(
+app.clientside_callback(
+    """
+    function(text) {
+        text = text || "";
+        const words = text.split(/\\s+/).filter(x => x).length;
+        const pages = text.trim().split(">>>>>>>>>>> End Page").filter(x => x).length;
+        return `Document: ${text.length}c ${words}w ${pages}p`;
+    }
+    """,
     Output("counter-document", "children"),
     Input("textarea-file-edit", "value"),
-    prevent_initial_call=False,
 )
-def update_counter_document(text):
-    if text is None:
-        words = chars = pages = 0
-    else:
-        chars = len(text)
-        words = len(text.split())
-        pages = len([x for x in text.strip().split(">>>>>>>>>>> End Page") if x])
-    return f"Document: {chars}c {words}w {pages}p"
 
-
-@app.callback(
+app.clientside_callback(
+    """
+    function(text) {
+        text = text || "";
+        const words = text.split(/\\s+/).filter(x => x).length;
+        return `Summary: ${text.length}c ${words}w`;
+    }
+    """,
     Output("counter-summary", "children"),
     Input("textarea-summary-edit", "value"),
-    prevent_initial_call=False,
 )
-def update_counter_summary(text):
-    if text is None:
-        words = chars = 0
-    else:
-        chars = len(text)
-        words = len(text.split())
-    return f"Summary: {chars}c {words}w"
 
-
-@app.callback(
+app.clientside_callback(
+    """
+    function(text, ttsModel) {
+        text = text || "";
+        const CHARS2SEC = 1 / 20;  // This is a rough estimate - TODO: improve
+        const TTS_COSTS = %s;  // per 10k chars
+        const words = text.split(/\\s+/).filter(x => x).length;
+        const dialogues = text.trim().split("<speaker").filter(x => x).length;
+        const estimatedAudioSeconds = Math.floor(text.length * CHARS2SEC);
+        const estimatedPrice = (TTS_COSTS[ttsModel] || 0) * text.length / 10000;
+        const minutes = Math.floor(estimatedAudioSeconds / 60);
+        const seconds = String(estimatedAudioSeconds %% 60).padStart(2, "0");
+        return [
+            `Transcription: ${text.length}c ${words}w ${dialogues}d`,
+            `Audio:   ${minutes}:${seconds}s $${estimatedPrice.toFixed(2)}`,
+        ];
+    }
+    """
+    % json.dumps({x["model"]: x["cost"] for x in TTS_OPTIONS}),
     Output("counter-transcript", "children"),
     Output("counter-audio", "children"),
     Input("textarea-transcript-edit", "value"),
     Input("dropdown-model-tts", "value"),
 )
-def update_counter_transcript(text, tts_model):
-    if text is None:
-        words = chars = dialogues = estimated_audio_seconds = estimated_price = 0
-    else:
-        CHARS2SEC = 1 / 20  # This is a rough estimate - TODO: improve
-        words = len(text.split())
-        chars = len(text)
-        dialogues = len([x for x in text.strip().split("<speaker") if x])
-        estimated_audio_seconds = int(chars * CHARS2SEC)
-        estimated_price = get_tts_cost(tts_model, chars)
 
-    minutes, seconds = divmod(estimated_audio_seconds, 60)
 
-    return [
-        f"Transcription: {chars}c {words}w {dialogues}d",
-        f"Audio:   {minutes:d}:{seconds:02d}s ${estimated_price:.2f}",
+#### PROFILING #################################################################
+
+PROFILE_DIRECTORY = None  # set by profile_callbacks, when run with --profile
+PROFILE_RECENT = deque(maxlen=500)
+PROFILE_LOCK = threading.Lock()
+# Since Python 3.12, a single profiler can be enabled at a time (sys.monitoring), before each thread has its own:
+# the invocations that cannot enable one run without profiler, and are counted
+PROFILE_SKIPPED = Counter()
+
+
+def _profiled(func, directory):
+    name = getattr(func, "__name__", "callback")
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except (
+            ValueError
+        ):  # another invocation is profiled, or another tool, e.g., a debugger
+            with PROFILE_LOCK:
+                PROFILE_SKIPPED[name] += 1
+            return func(*args, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            seconds = time.perf_counter() - start
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+            filename = f"{timestamp}_{name}.prof"
+            profiler.dump_stats(os.path.join(directory, filename))
+            with PROFILE_LOCK:
+                PROFILE_RECENT.append(
+                    {
+                        "callback": name,
+                        "seconds": seconds,
+                        "filename": filename,
+                        "timestamp": timestamp,
+                    }
+                )
+
+    return wrapper
+
+
+def profile_callbacks(dash_app, directory):
+    """Wrap every registered server-side callback with cProfile, saving a .prof file in directory
+    for each invocation. Nothing is wrapped unless this is called, so that there is no cost by default.
+    """
+    global PROFILE_DIRECTORY
+    PROFILE_DIRECTORY = directory
+    os.makedirs(directory, exist_ok=True)
+    for callback in dash_app.callback_map.values():
+        if "callback" in callback:  # clientside callbacks have no python function
+            callback["callback"] = _profiled(callback["callback"], directory)
+
+
+@server.route("/profiles")
+def list_profiles():
+    """Page listing the slowest recent callback invocations, with the top functions of each profile."""
+    if PROFILE_DIRECTORY is None:
+        abort(404, "Profiling is disabled: run the app with --profile")
+
+    with PROFILE_LOCK:
+        slowest = sorted(PROFILE_RECENT, key=lambda x: x["seconds"], reverse=True)[:20]
+        skipped = ", ".join(f"{k}: {v}" for k, v in PROFILE_SKIPPED.most_common())
+
+    rows = []
+    for invocation in slowest:
+        with io.StringIO() as stream:
+            stats = pstats.Stats(
+                os.path.join(PROFILE_DIRECTORY, invocation["filename"]), stream=stream
+            )
+            stats.sort_stats("cumulative").print_stats(15)
+            top_functions = html_escape(stream.getvalue())
+        rows.append(
+            f"<tr><td>{invocation['timestamp']}</td><td>{invocation['callback']}</td>"
+            f"<td>{invocation['seconds']:.3f}s</td>"
+            f"<td><details><summary>{invocation['filename']}</summary><pre>{top_functions}</pre></details></td>"
+            f"<td><a href='/profiles/{invocation['filename']}'>download</a></td></tr>"
+        )
+
+    return (
+        f"<h3>Slowest recent callbacks (profiles saved in {html_escape(PROFILE_DIRECTORY)})</h3>"
+        f"<p>Not profiled, as overlapping a profiled invocation (Python 3.12+): {html_escape(skipped or 'none')}</p>"
+        "<table border='1' cellpadding='5'>"
+        "<tr><th>Time</th><th>Callback</th><th>Duration</th><th>Profile</th><th></th></tr>"
+        + "".join(rows)
+        + "</table>"
+    )
+
+
+@server.route("/profiles/<path:filename>")
+def download_profile(filename):
+    if PROFILE_DIRECTORY is None:
+        abort(404, "Profiling is disabled: run the app with --profile")
+    return send_from_directory(PROFILE_DIRECTORY, filename)
+
+
+#### BATCH MODE ################################################################
+# Offline processing of a directory of PDFs through the Batch API (cheaper, with separate rate limits).
+# The state is saved after every change, so the same command resumes an interrupted run.
+# The TTS endpoint can't be batched: the audio is synthesized with the usual requests at the end.
+
+BATCH_STEPS = [  # step, input step, prompt
+    ("summary", "file", DEFAULT_SUMMARY_PROMPT),
+    ("transcript", "summary", DEFAULT_TRANSCRIPT_PROMPT),
+]
+BATCH_DONE_STATUSES = ["completed", "failed", "expired", "cancelled"]
+
+
+def get_batch_state_path(pdf_directory):
+    key = hashlib.sha256(os.path.abspath(pdf_directory).encode()).hexdigest()[:16]
+    return os.path.join(BATCH_DIRECTORY, f"{key}.json")
+
+
+def save_batch_state(state_path, state):
+    write_atomic(state_path, json.dumps(state, indent=4))
+
+
+def submit_batch(client, step, prompt, model, documents):
+    """Upload the requests of a step as JSONL, one per document (identified by its upload id), and start the batch."""
+    lines = [
+        json.dumps(
+            {
+                "custom_id": upload_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": model,
+                    "temperature": 1.0,
+                    "messages": [
+                        {"role": "system", "content": prompt},
+                        {"role": "user", "content": document[input_step]},
+                    ],
+                },
+            }
+        )
+        for upload_id, document, input_step in documents
     ]
+    batch_file = client.files.create(
+        file=(f"voicemydocs_{step}.jsonl", "\n".join(lines).encode()),
+        purpose="batch",
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    return batch.id
+
+
+def collect_batch(client, batch):
+    """Return the successful responses of a finished batch, as {upload id: text}."""
+    results = {}
+    if batch.output_file_id:
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            output = json.loads(line)
+            response = output.get("response") or {}
+            if response.get("status_code") == 200:
+                message = response["body"]["choices"][0]["message"]
+                results[output["custom_id"]] = message["content"]
+    return results
+
+
+def run_batch(
+    pdf_directory,
+    api_key=OPENAI_API_KEY,
+    summary_model=MODEL_DEFAULT,
+    transcript_model=MODEL_DEFAULT,
+    tts_model=TTS_DEFAULT["model"],
+    speakers_voice=["nova", "echo", "onyx"],
+    poll_interval=60,
+    max_attempts=3,
+):
+    """Summarize, transcribe and voice every PDF in pdf_directory, saving each one as a project.
+    The summaries of all the documents are a single batch job, then the transcripts another one:
+    the requests that failed are submitted again, up to max_attempts batches per step.
+    """
+    from openai import OpenAI  # imported lazily to keep the startup fast
 
+    client = OpenAI(api_key=api_key)
+    models = {"summary": summary_model, "transcript": transcript_model}
+    state_path = get_batch_state_path(pdf_directory)
+    if os.path.exists(state_path):
+        with open(state_path) as state_file:
+            state = json.load(state_file)
+    else:
+        state = {"directory": os.path.abspath(pdf_directory), "documents": {}}
+    state.setdefault("batches", {})
+    documents = state["documents"]
+    attempts = Counter()  # per run, so that a new run retries the failed documents
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Run the VoiceMyDocs app.")
+    for name in sorted(os.listdir(pdf_directory)):
+        if not name.lower().endswith(".pdf"):
+            continue
+        pdf_path = os.path.join(pdf_directory, name)
+        with open(pdf_path, "rb") as pdf_file:
+            upload_id = hashlib.sha256(pdf_file.read()).hexdigest()
+        if upload_id not in documents:
+            documents[upload_id] = {
+                "name": name,
+                "file": extract_text_from_pdf(pdf_path),
+            }
+            save_batch_state(state_path, state)
+
+    for step, input_step, prompt in BATCH_STEPS:
+        while True:
+            batch_id = state["batches"].get(step)
+            if batch_id is None:
+                pending = [
+                    (upload_id, document, input_step)
+                    for upload_id, document in documents.items()
+                    if step not in document and document.get(input_step)
+                ]
+                if not pending or attempts[step] >= max_attempts:
+                    break
+                batch_id = submit_batch(client, step, prompt, models[step], pending)
+                state["batches"][step] = batch_id
+                attempts[step] += 1
+                save_batch_state(state_path, state)
+                print(f"Submitted the {step} of {len(pending)} documents: {batch_id}")
+
+            batch = client.batches.retrieve(batch_id)
+            if batch.status not in BATCH_DONE_STATUSES:
+                print(f"Batch {batch_id} ({step}) is {batch.status}...")
+                time.sleep(poll_interval)
+                continue
+
+            results = collect_batch(client, batch)
+            for upload_id, text in results.items():
+                documents[upload_id][step] = text
+            del state["batches"][step]
+            save_batch_state(state_path, state)
+            print(f"Batch {batch_id} ({step}) {batch.status}: {len(results)} responses")
+
+    for upload_id, document in documents.items():
+        if "transcript" not in document or "project" in document:
+            continue
+        try:
+            job_id = start_tts_job(
+                document["transcript"], speakers_voice, tts_model, api_key
+            )
+        except ValueError as error:  # e.g., too many speakers
+            print(f"Skipped {document['name']}: {error}")
+            continue
+        segment_keys = wait_tts_job(job_id)
+        draft_dict = get_log_dict(
+            document["file"],
+            DEFAULT_SUMMARY_PROMPT,
+            summary_model,
+            document["summary"],
+            DEFAULT_TRANSCRIPT_PROMPT,
+            transcript_model,
+            document["transcript"],
+            tts_model,
+            *speakers_voice,
+        )
+        draft_dict["audio-segments"] = segment_keys
+        document["project"] = save_checkpoint(None, draft_dict)
+        save_batch_state(state_path, state)
+        print(f"Saved {document['name']} as project {document['project']}")
+
+    missing = [x["name"] for x in documents.values() if "project" not in x]
+    if missing:
+        print(f"{len(missing)} documents could not be completed: {', '.join(missing)}")
+    return state
+
+
+def run_cli(argv=None, prog=None):
+    """Run the development server (or the batch mode), see also voicemydocs.main."""
+    parser = argparse.ArgumentParser(prog=prog, description="Run the VoiceMyDocs app.")
     parser.add_argument(
         "--debug", action="store_true", help="Run the app in debug mode."
     )
-    args = parser.parse_args()
+    parser.add_argument("--host", default="127.0.0.1", help="Host to listen on.")
+    parser.add_argument("--port", type=int, default=8050, help="Port to listen on.")
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=os.path.join(CACHE_DIRECTORY, "profiles"),
+        default=None,
+        metavar="DIRECTORY",
+        help="Profile each callback invocation, saving the profiles in DIRECTORY "
+        "(default .voicemydocs_cache/profiles). The slowest are listed at /profiles.",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="DIRECTORY",
+        help="Instead of running the app, make a project of each PDF in DIRECTORY using the Batch API. "
+        "Running the same command again resumes the previous run.",
+    )
+    parser.add_argument("--summary-model", default=MODEL_DEFAULT, choices=MODEL_OPTIONS)
+    parser.add_argument(
+        "--transcript-model", default=MODEL_DEFAULT, choices=MODEL_OPTIONS
+    )
+    parser.add_argument(
+        "--tts-model",
+        default=TTS_DEFAULT["model"],
+        choices=[x["model"] for x in TTS_OPTIONS],
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=60,
+        help="Seconds between the checks of a batch.",
+    )
+    args = parser.parse_args(argv)
+
+    if args.batch:
+        run_batch(
+            args.batch,
+            summary_model=args.summary_model,
+            transcript_model=args.transcript_model,
+            tts_model=args.tts_model,
+            poll_interval=args.poll_interval,
+        )
+        return
+
+    if args.profile:
+        profile_callbacks(app, args.profile)
 
-    app.run(debug=args.debug)
+    app.run(debug=args.debug, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    run_cli()
@@ -0,0 +1,101 @@
+"""Command line of VoiceMyDocs.
+
+voicemydocs [run] [--debug] [--port 8050] ...   the development server, or the batch mode (see run --help)
+voicemydocs serve [--workers 4] [--threads 8]   the production server, with gunicorn (pip install voicemydocs[serve])
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+
+
+def serve(host, port, workers, threads, timeout):
+    """Serve the app with gunicorn: the app is loaded once (preload_app), and then forked into the worker processes,
+    each handling the requests with a pool of threads (the callbacks mostly wait for the OpenAI API).
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit(
+            "voicemydocs serve requires gunicorn: pip install voicemydocs[serve]"
+        )
+
+    options = {
+        "bind": f"{host}:{port}",
+        "workers": workers,
+        "threads": threads,
+        "worker_class": "gthread",
+        "preload_app": True,
+        "timeout": timeout,
+    }
+
+    if workers > 1:  # the requests of a session can reach any process
+        os.environ.setdefault("VOICEMYDOCS_TEXT_STORE", "sqlite")
+        if "VOICEMYDOCS_METRICS_DIRECTORY" not in os.environ:  # summed by /metrics
+            metrics_directory = tempfile.mkdtemp(prefix="voicemydocs_metrics_")
+            os.environ["VOICEMYDOCS_METRICS_DIRECTORY"] = metrics_directory
+            # on_exit runs in the master only, after the workers have exited
+            options["on_exit"] = lambda arbiter: shutil.rmtree(
+                metrics_directory, ignore_errors=True
+            )
+
+    class Application(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from voicemydocs.app import server
+
+            return server
+
+    Application().run()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="voicemydocs", description="Convert PDF files to audios and podcasts."
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser(
+        "run",
+        add_help=False,  # the arguments are parsed by voicemydocs.app.run_cli
+        help="Run the development server, or the batch mode (default, see run --help).",
+    )
+    serve_parser = subparsers.add_parser(
+        "serve", help="Run the production server, with several processes."
+    )
+    serve_parser.add_argument("--host", default="127.0.0.1", help="Host to listen on.")
+    serve_parser.add_argument(
+        "--port", type=int, default=8050, help="Port to listen on."
+    )
+    serve_parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of processes (default: number of CPUs).",
+    )
+    serve_parser.add_argument(
+        "--threads", type=int, default=8, help="Number of threads of each process."
+    )
+    serve_parser.add_argument(
+        "--timeout",
+        type=int,
+        default=120,
+        help="Seconds after which a silent worker is restarted.",
+    )
+    args, rest = parser.parse_known_args(argv)
+
+    if args.command == "serve":
+        if rest:
+            parser.error(f"unrecognized arguments: {' '.join(rest)}")
+        serve(args.host, args.port, args.workers, args.threads, args.timeout)
+    else:
+        from voicemydocs.app import run_cli
+
+        run_cli(rest, prog="voicemydocs run")
+
+
+if __name__ == "__main__":
+    main()